@@ -38,8 +38,12 @@ import omero
 from omero.rtypes import rstring, rlong, robject
 from omero.constants.namespaces import NSCREATED, NSOMETIFF
 import os
+import sys
 
-import glob
+import array
+import math
+import threading
+import Queue
 import zipfile
 from datetime import datetime
 
@@ -48,13 +52,49 @@ try:
 except ImportError:
     import Image
 
+# ANTIALIAS is called LANCZOS in newer Pillow (and removed in Pillow 10)
+ANTIALIAS = getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+BOX = getattr(Image, "BOX", ANTIALIAS)
+# raw mode to read the ARGB ints of renderAsPackedInt in native byte order
+if sys.byteorder == 'little':
+    PACKED_INT_MODE = 'BGRA'
+else:
+    PACKED_INT_MODE = 'ARGB'
+
 # keep track of log strings.
 logStrings = []
 
+# width and height of the regions rendered when exporting 'Big' images
+TILE_SIZE = 1024
+
+# limits of the block size (bytes) used to download OME-TIFF files
+MIN_BLOCK_SIZE = 65536
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+# max number of downloaded blocks waiting to be written to disk
+WRITE_QUEUE_SIZE = 4
+
+# rough size in bytes of a saved RGB pixel, to estimate the size of exports
+SAVED_PIXEL_BYTES = {"JPEG": 0.3, "PNG": 1.5, "TIFF": 3}
+# size in bytes of a pixel for each pixels type, to estimate OME-TIFF sizes
+PIXELS_TYPE_BYTES = {"bit": 1, "int8": 1, "uint8": 1, "int16": 2,
+                     "uint16": 2, "int32": 4, "uint32": 4, "float": 4,
+                     "double": 8}
+
+# max number of images in the metadata queries
+QUERY_BATCH_SIZE = 1000
+
+# used to check names of saved files when exporting concurrently
+nameLock = threading.Lock()
+# log lines of the job running in each thread, see runJobs()
+jobLog = threading.local()
+# BlitzGateway.createRenderingEngine() is not thread-safe
+renderingEngineLock = threading.Lock()
+
 
 def log(text):
     """
     Adds the text to a list of logs. Compiled into text file at the end.
+    Logs of a job run by runJobs() are kept together until it finishes.
     """
     # Handle unicode
     try:
@@ -62,7 +102,10 @@ def log(text):
     except:
         pass
     print text
-    logStrings.append(str(text))
+    lines = getattr(jobLog, "lines", None)
+    if lines is None:
+        lines = logStrings
+    lines.append(str(text))
 
 
 def compress(target, base):
@@ -75,16 +118,142 @@ def compress(target, base):
     """
     zip_file = zipfile.ZipFile(target, 'w')
     try:
-        files = os.path.join(base, "*")
-        for name in glob.glob(files):
-            zip_file.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
+        for root, dirs, files in os.walk(base):
+            for f in files:
+                name = os.path.join(root, f)
+                zip_file.write(name, os.path.relpath(name, base),
+                               zipfile.ZIP_DEFLATED)
 
     finally:
         zip_file.close()
 
 
+def prepareRenderingEngine(image):
+    """
+    Prepares the rendering engine of the image. Exports running at the same
+    time would otherwise be able to get the same (stateful) engine.
+    """
+    renderingEngineLock.acquire()
+    try:
+        image._prepareRenderingEngine()
+    finally:
+        renderingEngineLock.release()
+
+
+def getResolutionLevels(image):
+    """
+    Returns a list of (level, sizeX, sizeY) for each resolution of the image,
+    starting with the full size image. Level is the rendering engine
+    resolution level (0 is the smallest) or None if the image has no pyramid.
+    """
+    prepareRenderingEngine(image)
+    if not image._re.requiresPixelsPyramid():
+        return [(None, image.getSizeX(), image.getSizeY())]
+    descriptions = image._re.getResolutionDescriptions()
+    count = len(descriptions)
+    return [(count - 1 - i, d.sizeX, d.sizeY)
+            for i, d in enumerate(descriptions)]
+
+
+def renderTile(image, z, t, x, y, width, height, level=None):
+    """
+    Renders a region of the plane at the chosen resolution level and returns
+    it as a PIL image, without any lossy compression.
+    """
+    if level is not None:
+        image._re.setResolutionLevel(level)
+    planeDef = omero.romio.PlaneDef()
+    planeDef.z = z
+    planeDef.t = t
+    planeDef.region = omero.romio.RegionDef(x, y, width, height)
+    packed = array.array(
+        'i', image._re.renderAsPackedInt(planeDef, image._conn.SERVICE_OPTS))
+    # the bytes are read in native byte order, with no byte swapping
+    tile = Image.frombuffer('RGBA', (width, height), packed.tostring(),
+                            'raw', PACKED_INT_MODE, 0, 1)
+    return tile.convert('RGB')
+
+
+def saveTiles(image, format, cName, zRange, t, folder_name=None):
+    """
+    Renders a 'Big' image region by region and saves each tile to disk, so
+    that only a single tile is held in memory at any time.
+
+    Each resolution level is saved in its own folder, E.g.
+    imgDir/image01_DAPI_z01_t01.tiles/0/3_2.png is the tile in column 3,
+    row 2 of the full size image (level 0). Lower resolutions are in
+    folders 1, 2 etc.
+
+    @param zRange:          Tuple of (zIndex,). Projection is not supported
+    @param t:               T index
+    """
+
+    if format == "PNG":
+        extension = "png"
+    elif format == "TIFF":
+        extension = "tiff"
+    else:
+        extension = "jpg"
+    tileDir = makeImageName(
+        image.getName(), cName, zRange, t, "tiles", folder_name,
+        directory=True)
+    log("Saving tiles in: %s" % tileDir)
+
+    # All Z and T indices in this script are 1-based, but this method uses
+    # 0-based.
+    z = zRange[0]-1
+    for i, (level, sizeX, sizeY) in enumerate(getResolutionLevels(image)):
+        levelDir = os.path.join(tileDir, str(i))
+        os.mkdir(levelDir)
+        log("  Level %d: %d x %d" % (i, sizeX, sizeY))
+        for y in range(0, sizeY, TILE_SIZE):
+            for x in range(0, sizeX, TILE_SIZE):
+                width = min(TILE_SIZE, sizeX - x)
+                height = min(TILE_SIZE, sizeY - y)
+                tileName = os.path.join(levelDir, "%d_%d.%s" % (
+                    x / TILE_SIZE, y / TILE_SIZE, extension))
+                if format not in ("PNG", "TIFF"):
+                    # save the compressed data from the server as it is
+                    jpeg = image.renderJpegRegion(z, t-1, x, y, width, height,
+                                                  level=level)
+                    f = open(tileName, "wb")
+                    try:
+                        f.write(jpeg)
+                    finally:
+                        f.close()
+                else:
+                    tile = renderTile(image, z, t-1, x, y, width, height,
+                                      level)
+                    tile.save(tileName, format)
+
+
+def getZoomSize(sizeX, sizeY, zoomPercent):
+    """
+    Returns the (width, height) of a sizeX, sizeY plane zoomed by zoomPercent.
+    Computed once per image and used for every plane.
+    """
+    fraction = float(zoomPercent) / 100
+    return (max(1, int(math.ceil(sizeX * fraction))),
+            max(1, int(math.ceil(sizeY * fraction))))
+
+
+def resizePlane(plane, zoomPercent, zoomSize):
+    """
+    Resizes the PIL image to zoomSize. 50% and 25% are a fast reduction by
+    averaging 2x2 or 4x4 pixel blocks, other zooms use ANTIALIAS.
+    """
+    if zoomPercent < 100 and 100 % zoomPercent == 0:
+        factor = 100 / zoomPercent
+        if hasattr(plane, "reduce"):
+            # Pillow 7+
+            return plane.reduce(factor)
+        return plane.resize(zoomSize, BOX)
+    return plane.resize(zoomSize, ANTIALIAS)
+
+
 def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
-              greyscale=False, zoomPercent=None, folder_name=None):
+              greyscale=False, zoomPercent=None, folder_name=None,
+              tiled=False, zoomSize=None):
     """
     Renders and saves an image to disk.
 
@@ -100,6 +269,10 @@ def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
     @param greyscale:       If true, all visible channels will be
                             greyscale
     @param zoomPercent:     Resize image by this percent if specified.
+    @param zoomSize:        (width, height) after zoom. Calculated from
+                            zoomPercent if not specified.
+    @param tiled:           If true, save the plane as tiles. Used for 'Big'
+                            images. Zoom and projection are ignored.
     """
 
     originalName = image.getName()
@@ -121,6 +294,9 @@ def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
             image.setGreyscaleRenderingModel()
         else:
             image.setColorRenderingModel()
+    if tiled:
+        saveTiles(image, format, cName, zRange, t, folder_name)
+        return
     if projectZ:
         # imageWrapper only supports projection of full Z range (can't
         # specify)
@@ -130,9 +306,10 @@ def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
     # 0-based.
     plane = image.renderImage(zRange[0]-1, t-1)
     if zoomPercent:
-        w, h = plane.size
-        fraction = (float(zoomPercent) / 100)
-        plane = plane.resize((w * fraction, h * fraction), Image.ANTIALIAS)
+        if zoomSize is None:
+            w, h = plane.size
+            zoomSize = getZoomSize(w, h, zoomPercent)
+        plane = resizePlane(plane, zoomPercent, zoomSize)
 
     if format == "PNG":
         imgName = makeImageName(
@@ -151,10 +328,13 @@ def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
         plane.save(imgName)
 
 
-def makeImageName(originalName, cName, zRange, t, extension, folder_name):
+def makeImageName(originalName, cName, zRange, t, extension, folder_name,
+                  directory=False):
     """
     Produces the name for the saved image.
     E.g. imported/myImage.dv -> myImage_DAPI_z13_t01.png
+    An empty file (or a folder if directory is True) is created with that
+    name, so that concurrent exports can't choose the same name.
     """
     name = os.path.basename(originalName)
     # name = name.rsplit(".",1)[0]  # remove extension
@@ -168,15 +348,24 @@ def makeImageName(originalName, cName, zRange, t, extension, folder_name):
     # check we don't overwrite existing file
     i = 1
     name = imgName[:-(len(extension)+1)]
-    while os.path.exists(imgName):
-        imgName = "%s_(%d).%s" % (name, i, extension)
-        i += 1
+    nameLock.acquire()
+    try:
+        while os.path.exists(imgName):
+            imgName = "%s_(%d).%s" % (name, i, extension)
+            i += 1
+        if directory:
+            os.mkdir(imgName)
+        else:
+            open(imgName, "wb").close()
+    finally:
+        nameLock.release()
     return imgName
 
 
-def saveAsOmeTiff(conn, image, folder_name=None):
+def makeOmeTiffName(image, folder_name=None):
     """
-    Saves the image as an ome.tif in the specified folder
+    Produces the name for the saved ome.tif and creates an empty file with
+    that name, so that concurrent exports can't choose the same name.
     """
 
     extension = "ome.tif"
@@ -187,23 +376,152 @@ def saveAsOmeTiff(conn, image, folder_name=None):
     # check we don't overwrite existing file
     i = 1
     pathName = imgName[:-(len(extension)+1)]
-    while os.path.exists(imgName):
-        imgName = "%s_(%d).%s" % (pathName, i, extension)
-        i += 1
+    nameLock.acquire()
+    try:
+        while os.path.exists(imgName):
+            imgName = "%s_(%d).%s" % (pathName, i, extension)
+            i += 1
+        open(str(imgName), "wb").close()
+    finally:
+        nameLock.release()
+    return imgName
+
+
+def getBlockSize(fileSize):
+    """
+    Returns the size of the blocks to read from the exporter for a file of
+    fileSize bytes: aiming for ~100 reads per file, within the limits of
+    MIN_BLOCK_SIZE and MAX_BLOCK_SIZE.
+    """
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, fileSize / 100))
+
+
+def writeBlocks(imgName, blocks, errors):
+    """
+    Writes the blocks from the queue to the file until None is received.
+    Any error is added to errors and the remaining blocks are discarded, so
+    that the reader is never blocked.
+    """
+    f = None
+    try:
+        f = open(str(imgName), "wb")
+    except Exception, e:
+        errors.append(e)
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if not errors:
+                try:
+                    f.write(block)
+                except Exception, e:
+                    errors.append(e)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def saveAsOmeTiff(conn, image, folder_name=None, imgName=None):
+    """
+    Saves the image as an ome.tif in the specified folder.
+    Blocks are downloaded while the previous ones are written to disk.
+    """
+
+    if imgName is None:
+        imgName = makeOmeTiffName(image, folder_name)
 
     log("  Saving file as: %s" % imgName)
-    fileSize, block_gen = image.exportOmeTiff(bufsize=65536)
-    f = open(str(imgName), "wb")
-    for piece in block_gen:
-        f.write(piece)
-    # f.seek(0)
-    f.close()
+    exporter = conn.createExporter()
+    try:
+        exporter.addImage(image.getId())
+        fileSize = exporter.generateTiff(conn.SERVICE_OPTS)
+        blockSize = getBlockSize(fileSize)
+        blocks = Queue.Queue(WRITE_QUEUE_SIZE)
+        errors = []
+        writer = threading.Thread(target=writeBlocks,
+                                  args=(imgName, blocks, errors))
+        writer.start()
+        try:
+            pos = 0
+            while pos < fileSize and not errors:
+                block = exporter.read(pos, min(blockSize, fileSize - pos))
+                if not block:
+                    break
+                blocks.put(block)
+                pos += len(block)
+        finally:
+            blocks.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+    finally:
+        exporter.close()
+
+
+def runJobs(jobs, function, maxWorkers=1):
+    """
+    Calls function(job) for each job, in order, with up to maxWorkers jobs
+    running at the same time. A job that fails is logged and does not stop
+    the others. The log lines of each job are added to the log in one block
+    when it finishes, so that the logs of concurrent jobs are not mixed.
+
+    @return:        List of the jobs that failed
+    """
+
+    todo = Queue.Queue()
+    for job in jobs:
+        todo.put(job)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                job = todo.get_nowait()
+            except Queue.Empty:
+                return
+            jobLog.lines = []
+            try:
+                function(job)
+            except Exception, e:
+                log("  ** Export failed: %s **" % e)
+                failed.append(job)
+            finally:
+                logStrings.extend(jobLog.lines)
+                jobLog.lines = None
+
+    workers = [threading.Thread(target=worker)
+               for i in range(max(1, min(maxWorkers, len(jobs))))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return failed
+
+
+def saveAsOmeTiffs(conn, images, folder_name=None, maxExports=1):
+    """
+    Saves each image as an ome.tif in the specified folder, running up to
+    maxExports exports at the same time.
+
+    @return:        List of the images that failed to export
+    """
+
+    def export(image):
+        imgName = makeOmeTiffName(image, folder_name)
+        try:
+            saveAsOmeTiff(conn, image, imgName=imgName)
+        except Exception:
+            os.remove(str(imgName))
+            raise
+
+    return runJobs(images, export, maxExports)
 
 
 def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
                        channelNames=None, zRange=None, tRange=None,
                        greyscale=False, zoomPercent=None, projectZ=False,
-                       format="PNG", folder_name=None):
+                       format="PNG", folder_name=None, tiled=False):
     """
     Saves all the required planes for a single image, either as individual
     planes or projection.
@@ -219,6 +537,7 @@ def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
                                 greyscale
     @param zoomPercent:         Resize image by this percent if specified.
     @param projectZ:            If true, project over Z range.
+    @param tiled:               If true, save each plane as tiles.
     """
 
     channels = []
@@ -248,6 +567,11 @@ def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
         else:
             tIndexes = [tRange[0]]
 
+    zoomSize = None
+    if zoomPercent:
+        zoomSize = getZoomSize(image.getSizeX(), image.getSizeY(),
+                               zoomPercent)
+
     cName = 'merged'
     for c in channels:
         if c is not None:
@@ -263,18 +587,242 @@ def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
             if zRange is None:
                 defaultZ = image.getDefaultZ()+1
                 savePlane(image, format, cName, (defaultZ,), projectZ, t, c,
-                          gScale, zoomPercent, folder_name)
+                          gScale, zoomPercent, folder_name, tiled,
+                          zoomSize)
             elif projectZ:
                 savePlane(image, format, cName, zRange, projectZ, t, c,
-                          gScale, zoomPercent, folder_name)
+                          gScale, zoomPercent, folder_name, tiled,
+                          zoomSize)
             else:
                 if len(zRange) > 1:
                     for z in range(zRange[0], zRange[1]):
                         savePlane(image, format, cName, (z,), projectZ, t, c,
-                                  gScale, zoomPercent, folder_name)
+                                  gScale, zoomPercent, folder_name, tiled,
+                                  zoomSize)
                 else:
                     savePlane(image, format, cName, zRange, projectZ, t, c,
-                              gScale, zoomPercent, folder_name)
+                              gScale, zoomPercent, folder_name, tiled,
+                              zoomSize)
+
+
+def getZrange(sizeZ, scriptParams):
+    """
+    Returns the 1-based Z range to export: None for default Z, (zIndex,) or
+    (zStart, zEnd+1)
+    """
+    zRange = None
+    if "Choose_Z_Section" in scriptParams:
+        zChoice = scriptParams["Choose_Z_Section"]
+        # NB: all Z indices in this script are 1-based
+        if zChoice == 'ALL Z planes':
+            zRange = (1, sizeZ+1)
+        elif "OR_specify_Z_index" in scriptParams:
+            zIndex = scriptParams["OR_specify_Z_index"]
+            zIndex = min(zIndex, sizeZ)
+            zRange = (zIndex,)
+        elif "OR_specify_Z_start_AND..." in scriptParams and \
+                "...specify_Z_end" in scriptParams:
+            start = scriptParams["OR_specify_Z_start_AND..."]
+            start = min(start, sizeZ)
+            end = scriptParams["...specify_Z_end"]
+            end = min(end, sizeZ)
+            # in case user got zStart and zEnd mixed up
+            zStart = min(start, end)
+            zEnd = max(start, end)
+            if zStart == zEnd:
+                zRange = (zStart,)
+            else:
+                zRange = (zStart, zEnd+1)
+    return zRange
+
+
+def getTrange(sizeT, scriptParams):
+    """
+    Returns the 1-based T range to export: None for default T, (tIndex,) or
+    (tStart, tEnd+1)
+    """
+    tRange = None
+    if "Choose_T_Section" in scriptParams:
+        tChoice = scriptParams["Choose_T_Section"]
+        # NB: all T indices in this script are 1-based
+        if tChoice == 'ALL T planes':
+            tRange = (1, sizeT+1)
+        elif "OR_specify_T_index" in scriptParams:
+            tIndex = scriptParams["OR_specify_T_index"]
+            tIndex = min(tIndex, sizeT)
+            tRange = (tIndex,)
+        elif "OR_specify_T_start_AND..." in scriptParams and \
+                "...specify_T_end" in scriptParams:
+            start = scriptParams["OR_specify_T_start_AND..."]
+            start = min(start, sizeT)
+            end = scriptParams["...specify_T_end"]
+            end = min(end, sizeT)
+            # in case user got zStart and zEnd mixed up
+            tStart = min(start, end)
+            tEnd = max(start, end)
+            if tStart == tEnd:
+                tRange = (tStart,)
+            else:
+                tRange = (tStart, tEnd+1)
+    return tRange
+
+
+def rangeLength(indexRange):
+    """ Number of indexes in a Z or T range from getZrange/getTrange """
+    if indexRange is None or len(indexRange) == 1:
+        return 1
+    return indexRange[1] - indexRange[0]
+
+
+def getChannelLabel(channel, index):
+    """
+    Label of an omero.model.ChannelI with its logicalChannel loaded: the
+    name, or the emission wavelength, or the index.
+    """
+    lc = channel.getLogicalChannel()
+    if lc.getName() is not None and len(lc.getName().getValue()) > 0:
+        return lc.getName().getValue()
+    if lc.getEmissionWave() is not None:
+        return str(lc.getEmissionWave().getValue())
+    return str(index)
+
+
+def loadMetadata(conn, images):
+    """
+    Loads the Pixels (with pixelsType and channels) and the current user's
+    rendering settings for all the images, in batches of QUERY_BATCH_SIZE
+    images, instead of lazy loading them image by image.
+
+    @return:        Map of imageId: {'pixels': omero.model.PixelsI,
+                    'channels': list of (label, windowStart, windowEnd)}.
+                    The channel windows are None if the user has no
+                    rendering settings for the image.
+    """
+    queryService = conn.getQueryService()
+    imageIds = list(set([i.getId() for i in images]))
+    metadata = {}
+    for i in range(0, len(imageIds), QUERY_BATCH_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(imageIds[i:i+QUERY_BATCH_SIZE])
+        query = "select distinct p from Pixels p join fetch p.pixelsType "\
+            "left outer join fetch p.channels as c "\
+            "left outer join fetch c.logicalChannel "\
+            "where p.image.id in (:ids)"
+        pixelsList = queryService.findAllByQuery(
+            query, params, conn.SERVICE_OPTS)
+        pixelsMap = {}
+        for p in pixelsList:
+            pixelsMap[p.getId().getValue()] = p
+            imageId = p.getImage().getId().getValue()
+            labels = [getChannelLabel(c, idx)
+                      for idx, c in enumerate(p.copyChannels())]
+            metadata[imageId] = {
+                'pixels': p,
+                'channels': [(label, None, None) for label in labels]}
+        if not pixelsMap:
+            continue
+
+        params = omero.sys.ParametersI()
+        params.addIds(pixelsMap.keys())
+        params.addLong("oid", conn.getUserId())
+        query = "select distinct r from RenderingDef r "\
+            "join fetch r.waveRendering "\
+            "where r.pixels.id in (:ids) and r.details.owner.id = :oid"
+        for rdef in queryService.findAllByQuery(
+                query, params, conn.SERVICE_OPTS):
+            pixels = pixelsMap[rdef.getPixels().getId().getValue()]
+            entry = metadata[pixels.getImage().getId().getValue()]
+            channels = []
+            for idx, cb in enumerate(rdef.copyWaveRendering()):
+                label = idx < len(entry['channels']) and \
+                    entry['channels'][idx][0] or str(idx)
+                channels.append((label, cb.getInputStart().getValue(),
+                                 cb.getInputEnd().getValue()))
+            entry['channels'] = channels
+    return metadata
+
+
+def planExport(conn, images, scriptParams, maxSize):
+    """
+    Works out what will be exported for every image before anything is
+    rendered, prefetching the metadata of all images with loadMetadata().
+    Duplicate images (same pixels) and images that can't be exported are
+    logged and left out.
+
+    @param maxSize:     Images with more pixels than this are 'Big'
+    @return:            List of job maps with keys: image, sizeX, sizeY,
+                        sizeC, zRange, tRange, channels, tiled, renders,
+                        bytes
+    """
+
+    splitCs = scriptParams["Export_Individual_Channels"]
+    mergedCs = scriptParams["Export_Merged_Image"]
+    format = scriptParams["Format"]
+    projectZ = "Choose_Z_Section" in scriptParams and \
+        scriptParams["Choose_Z_Section"] == 'Max projection'
+    zoom = 1.0
+    if "Zoom" in scriptParams:
+        zoom = float(scriptParams["Zoom"][:-1]) / 100
+
+    metadata = loadMetadata(conn, images)
+    pixelsIds = set()
+    jobs = []
+    for img in images:
+        if img.getId() not in metadata:
+            continue
+        pixels = metadata[img.getId()]['pixels']
+        if pixels.getId().getValue() in pixelsIds:
+            continue
+        pixelsIds.add(pixels.getId().getValue())
+        sizeX = pixels.getSizeX().getValue()
+        sizeY = pixels.getSizeY().getValue()
+        sizeZ = pixels.getSizeZ().getValue()
+        sizeC = pixels.getSizeC().getValue()
+        sizeT = pixels.getSizeT().getValue()
+        tiled = sizeX*sizeY > maxSize
+        if tiled and format == 'OME-TIFF':
+            log("  ** Can't export a 'Big' image to %s: %s **"
+                % (format, img.getName()))
+            continue
+        job = {'image': img, 'sizeX': sizeX, 'sizeY': sizeY, 'sizeC': sizeC,
+               'zRange': getZrange(sizeZ, scriptParams),
+               'tRange': getTrange(sizeT, scriptParams), 'tiled': tiled,
+               'channels': metadata[img.getId()]['channels']}
+
+        if format == 'OME-TIFF':
+            pixelsType = pixels.getPixelsType().getValue().getValue()
+            job['renders'] = 0
+            job['bytes'] = sizeX * sizeY * sizeZ * sizeC * sizeT * \
+                PIXELS_TYPE_BYTES.get(pixelsType, 2)
+            jobs.append(job)
+            continue
+
+        channels = (mergedCs and 1 or 0) + (splitCs and sizeC or 0)
+        zCount = 1
+        if not projectZ or tiled:
+            zCount = rangeLength(job['zRange'])
+        planes = channels * zCount * rangeLength(job['tRange'])
+        if tiled:
+            # full size tiles plus ~1/3 more for the smaller resolutions
+            tiles = ((sizeX + TILE_SIZE - 1) / TILE_SIZE) * \
+                ((sizeY + TILE_SIZE - 1) / TILE_SIZE)
+            job['renders'] = planes * (tiles * 4 / 3 or 1)
+            pixelCount = sizeX * sizeY * 4 / 3
+        else:
+            job['renders'] = planes
+            pixelCount = sizeX * sizeY * zoom * zoom
+        job['bytes'] = int(planes * pixelCount * SAVED_PIXEL_BYTES[format])
+        jobs.append(job)
+    return jobs
+
+
+def formatBytes(size):
+    """ E.g. 1536 -> '1.5 KB' """
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size = size / 1024.0
+    return "%.1f TB" % size
 
 
 def batchImageExport(conn, scriptParams):
@@ -302,59 +850,6 @@ def batchImageExport(conn, scriptParams):
     if "Zoom" in scriptParams and scriptParams["Zoom"] != "100%":
         zoomPercent = int(scriptParams["Zoom"][:-1])
 
-    # functions used below for each imaage.
-    def getZrange(sizeZ, scriptParams):
-        zRange = None
-        if "Choose_Z_Section" in scriptParams:
-            zChoice = scriptParams["Choose_Z_Section"]
-            # NB: all Z indices in this script are 1-based
-            if zChoice == 'ALL Z planes':
-                zRange = (1, sizeZ+1)
-            elif "OR_specify_Z_index" in scriptParams:
-                zIndex = scriptParams["OR_specify_Z_index"]
-                zIndex = min(zIndex, sizeZ)
-                zRange = (zIndex,)
-            elif "OR_specify_Z_start_AND..." in scriptParams and \
-                    "...specify_Z_end" in scriptParams:
-                start = scriptParams["OR_specify_Z_start_AND..."]
-                start = min(start, sizeZ)
-                end = scriptParams["...specify_Z_end"]
-                end = min(end, sizeZ)
-                # in case user got zStart and zEnd mixed up
-                zStart = min(start, end)
-                zEnd = max(start, end)
-                if zStart == zEnd:
-                    zRange = (zStart,)
-                else:
-                    zRange = (zStart, zEnd+1)
-        return zRange
-
-    def getTrange(sizeT, scriptParams):
-        tRange = None
-        if "Choose_T_Section" in scriptParams:
-            tChoice = scriptParams["Choose_T_Section"]
-            # NB: all T indices in this script are 1-based
-            if tChoice == 'ALL T planes':
-                tRange = (1, sizeT+1)
-            elif "OR_specify_T_index" in scriptParams:
-                tIndex = scriptParams["OR_specify_T_index"]
-                tIndex = min(tIndex, sizeT)
-                tRange = (tIndex,)
-            elif "OR_specify_T_start_AND..." in scriptParams and \
-                    "...specify_T_end" in scriptParams:
-                start = scriptParams["OR_specify_T_start_AND..."]
-                start = min(start, sizeT)
-                end = scriptParams["...specify_T_end"]
-                end = min(end, sizeT)
-                # in case user got zStart and zEnd mixed up
-                tStart = min(start, end)
-                tEnd = max(start, end)
-                if tStart == tEnd:
-                    tRange = (tStart,)
-                else:
-                    tRange = (tStart, tEnd+1)
-        return tRange
-
     # Get the images or datasets
     message = ""
     objects, logMessage = script_utils.getObjects(conn, scriptParams)
@@ -377,6 +872,33 @@ def batchImageExport(conn, scriptParams):
 
     log("Processing %s images" % len(images))
 
+    # max size (default 12kx12k)
+    size = conn.getDownloadAsMaxSizeSetting()
+    size = int(size)
+
+    maxExports = 1
+    if "Concurrent_Exports" in scriptParams:
+        maxExports = scriptParams["Concurrent_Exports"]
+
+    jobs = planExport(conn, images, scriptParams, size)
+    if not jobs:
+        if len(images) == 1 and format == 'OME-TIFF':
+            return None, "Can't export a 'Big' image to %s." % format
+        return None, "No images to export. See 'info' for more details"
+    totalRenders = sum([job['renders'] for job in jobs])
+    totalBytes = sum([job['bytes'] for job in jobs])
+    log("Export plan: %d images, %d render calls, ~%s"
+        % (len(jobs), totalRenders, formatBytes(totalBytes)))
+    for job in jobs:
+        log("  %s: %d render calls, ~%s"
+            % (job['image'].getName(), job['renders'],
+               formatBytes(job['bytes'])))
+    if "Dry_Run" in scriptParams and scriptParams["Dry_Run"]:
+        message += "Dry run: would export %d images as %s with %d render "\
+            "calls, ~%s." % (len(jobs), format, totalRenders,
+                             formatBytes(totalBytes))
+        return None, message
+
     # somewhere to put images
     curr_dir = os.getcwd()
     exp_dir = os.path.join(curr_dir, folder_name)
@@ -384,40 +906,22 @@ def batchImageExport(conn, scriptParams):
         os.mkdir(exp_dir)
     except:
         pass
-    # max size (default 12kx12k)
-    size = conn.getDownloadAsMaxSizeSetting()
-    size = int(size)
-
-    ids = []
-    # do the saving to disk
 
-    for img in images:
-        pixels = img.getPrimaryPixels()
-        if (pixels.getId() in ids):
-            continue
-        ids.append(pixels.getId())
-        sizeX = pixels.getSizeX()
-        sizeY = pixels.getSizeY()
-        if sizeX*sizeY > size:
-            log("  ** Can't export a 'Big' image to %s. **" % format)
-            if len(images) == 1:
-                return None, "Can't export a 'Big' image to %s." % format
-            continue
-        else:
-            log("Exporting image as %s: %s" % (format, img.getName()))
+    # start the biggest exports first so they don't hold up the end
+    jobs.sort(key=lambda job: job['bytes'], reverse=True)
 
-        if format == 'OME-TIFF':
-            saveAsOmeTiff(conn, img, folder_name)
-        else:
-            if img._prepareRE().requiresPixelsPyramid():
-                log("  ** Can't export a 'Big' image to OME-TIFF. **")
+    def exportImage(job):
+        img = job['image']
+        zRange = job['zRange']
+        tRange = job['tRange']
+        log("Exporting image as %s: %s" % (format, img.getName()))
+        prepareRenderingEngine(img)
+        try:
+            tiled = job['tiled'] or img._re.requiresPixelsPyramid()
+            if tiled:
+                log("  'Big' image: saving planes as %s tiles" % format)
             log("\n----------- Saving planes from image: '%s' ------------"
                 % img.getName())
-            sizeC = img.getSizeC()
-            sizeZ = img.getSizeZ()
-            sizeT = img.getSizeT()
-            zRange = getZrange(sizeZ, scriptParams)
-            tRange = getTrange(sizeT, scriptParams)
             log("Using:")
             if zRange is None:
                 log("  Z-index: Last-viewed")
@@ -425,7 +929,9 @@ def batchImageExport(conn, scriptParams):
                 log("  Z-index: %d" % zRange[0])
             else:
                 log("  Z-range: %s-%s" % (zRange[0], zRange[1]-1))
-            if projectZ:
+            if projectZ and tiled:
+                log("  Z-projection: not supported for 'Big' images")
+            elif projectZ:
                 log("  Z-projection: ON")
             if tRange is None:
                 log("  T-index: Last-viewed")
@@ -440,20 +946,35 @@ def batchImageExport(conn, scriptParams):
                 log("  Image Zoom: %s" % zoomPercent)
             log("  Greyscale: %s" % greyscale)
             log("Channel Rendering Settings:")
-            for ch in img.getChannels():
-                log("  %s: %d-%d"
-                    % (ch.getLabel(), ch.getWindowStart(), ch.getWindowEnd()))
+            channels = job['channels']
+            if channels and channels[0][1] is None:
+                # no settings prefetched - E.g. not saved by the current user
+                channels = [(ch.getLabel(), ch.getWindowStart(),
+                             ch.getWindowEnd()) for ch in img.getChannels()]
+            for label, start, end in channels:
+                log("  %s: %d-%d" % (label, start, end))
+
+            savePlanesForImage(
+                conn, img, job['sizeC'], splitCs, mergedCs, channelNames,
+                zRange, tRange, greyscale, zoomPercent,
+                projectZ=projectZ and not tiled, format=format,
+                folder_name=folder_name, tiled=tiled)
+        finally:
+            # Make sure we close Rendering Engine
+            img._re.close()
 
-            try:
-                savePlanesForImage(
-                    conn, img, sizeC, splitCs, mergedCs, channelNames, zRange,
-                    tRange, greyscale, zoomPercent, projectZ=projectZ,
-                    format=format, folder_name=folder_name)
-            finally:
-                # Make sure we close Rendering Engine
-                img._re.close()
+    # do the saving to disk
+    if format == 'OME-TIFF':
+        failed = saveAsOmeTiffs(conn, [job['image'] for job in jobs],
+                                folder_name, maxExports)
+    else:
+        failed = runJobs(jobs, exportImage, maxExports)
+    if failed:
+        message += "%d image(s) could not be exported. " % len(failed)
 
-        # write log for exported images (not needed for ome-tiff)
+    # write log for exported images (not needed for ome-tiff, so that a
+    # single ome-tiff is uploaded as it is, without zipping)
+    if format != 'OME-TIFF':
         logFile = open(os.path.join(exp_dir, 'Batch_Image_Export.txt'), 'w')
         try:
             for s in logStrings:
@@ -579,19 +1100,30 @@ See http://help.openmicroscopy.org/export.html#batch""",
 
         scripts.String(
             "Zoom", grouping="7", values=zoomPercents,
-            description="Zoom (jpeg, png or tiff) before saving with"
-            " ANTIALIAS interpolation", default="100%"),
+            description="Zoom (jpeg, png or tiff) before saving. 25% and 50%"
+            " average blocks of pixels, other zooms use ANTIALIAS"
+            " interpolation", default="100%"),
 
         scripts.String(
             "Format", grouping="8",
-            description="Format to save image", values=formats,
+            description="Format to save image. 'Big' images are saved as"
+            " tiles (not supported for OME-TIFF)", values=formats,
             default='JPEG'),
 
+        scripts.Int(
+            "Concurrent_Exports", grouping="8.1", default=2, min=1,
+            description="Number of images exported at the same time"),
+
         scripts.String(
             "Folder_Name", grouping="9",
             description="Name of folder (and zip file) to store images",
             default='Batch_Image_Export'),
 
+        scripts.Bool(
+            "Dry_Run", grouping="10", default=False,
+            description="Only report the number of images, render calls and"
+            " estimated size of the export, without exporting anything"),
+
         version="4.3.0",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
@@ -65,13 +65,15 @@ import omero.min  # Constants etc.
 import os
 import sys
 import re
+import subprocess
+import threading
+import Queue
 import numpy
-import omero.util.pixelstypetopython as pixelstypetopython
-from struct import unpack
-from omero.rtypes import wrap, rstring, rint, rlong, robject
+from omero.rtypes import wrap, rstring, rint, rlong, robject, rlist
 from omero.gateway import BlitzGateway
 from omero.constants.namespaces import NSCREATED
 from omero.constants.metadata import NSMOVIE
+from omero.constants.projection import ProjectionType
 
 from cStringIO import StringIO
 from types import StringTypes
@@ -82,6 +84,9 @@ except ImportError:
     import Image
     import ImageDraw  # see ticket:2597
 
+# ANTIALIAS is called LANCZOS in newer Pillow (and removed in Pillow 10)
+ANTIALIAS = getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+
 COLOURS = scriptUtil.COLOURS
 COLOURS.update(scriptUtil.EXTRA_COLOURS)    # name:(rgba) map
 
@@ -97,6 +102,23 @@ formatMimetypes = {
     QT: "video/quicktime",
     WMV: "video/x-ms-wmv"}
 OVERLAYCOLOUR = "#666666"
+NO_PROJECTION = 'None'
+projectionTypes = {
+    'Maximum Intensity': ProjectionType.MAXIMUMINTENSITY,
+    'Mean Intensity': ProjectionType.MEANINTENSITY}
+# max number of composited frames waiting to be encoded
+FRAME_QUEUE_SIZE = 8
+# number of PlaneInfo objects loaded per query
+PLANE_INFO_PAGE_SIZE = 5000
+# used to share the raw file store between movies
+uploadLock = threading.Lock()
+# BlitzGateway.createRenderingEngine() is not thread-safe
+renderingEngineLock = threading.Lock()
+# raw mode to read the ARGB ints of renderAsPackedInt in native byte order
+if sys.byteorder == 'little':
+    PACKED_INT_MODE = 'BGRA'
+else:
+    PACKED_INT_MODE = 'ARGB'
 
 
 logLines = []    # make a log / legend of the figure
@@ -111,25 +133,6 @@ def log(text):
     logLines.append(text)
 
 
-def downloadPlane(gateway, pixels, pixelsId, x, y, z, c, t):
-    """ Retrieves the selected plane """
-    rawPlane = gateway.getPlane(pixelsId, z, c, t)
-    convertType = '>' + str(x*y) + pixelstypetopython.toPython(
-        pixels.getPixelsType().getValue())
-    convertedPlane = unpack(convertType, rawPlane)
-    remappedPlane = numpy.array(
-        convertedPlane, dtype=(pixels.getPixelsType().getValue()))
-    remappedPlane.resize(x, y)
-    return remappedPlane
-
-
-def uploadPlane(gateway, newPixelsId, x, y, z, c, t, newPlane):
-    """Uploads the specified plane. """
-    byteSwappedPlane = newPlane.byteswap()
-    convertedPlane = byteSwappedPlane.tostring()
-    gateway.uploadPlane(newPixelsId, z, c, t, convertedPlane)
-
-
 def macOSX():
     """ Identifies if the Operating System is Mac or not."""
     if ('darwin' in sys.platform):
@@ -138,25 +141,83 @@ def macOSX():
         return 0
 
 
-def buildAVI(sizeX, sizeY, filelist, fps, movieName, format):
-    """ Encodes. """
-    program = 'mencoder'
-    args = ""
-    if (format == WMV):
-        args = ' mf://'+filelist + ' -mf w=' + str(sizeX) + ':h=' + \
-            str(sizeY) + ':fps=' + str(fps) + \
-            ':type=jpg -ovc lavc -lavcopts vcodec=wmv2 -o %s' % movieName
-    elif (format == QT):
-        args = ' mf://'+filelist + ' -mf w=' + str(sizeX) + ':h=' + \
-            str(sizeY) + ':fps='+str(fps) + \
-            ':type=png -ovc lavc -lavcopts vcodec=mjpeg:vbitrate=800  -o %s' \
-            % movieName
+def getEncoderArgs(sizeX, sizeY, fps, movieName, format):
+    """
+    Returns the mencoder command line to encode raw RGB frames, read from
+    stdin, into movieName.
+    """
+    if format == WMV:
+        codec = 'vcodec=wmv2'
+    elif format == QT:
+        codec = 'vcodec=mjpeg:vbitrate=800'
     else:
-        args = ' mf://'+filelist + ' -mf w=' + str(sizeX) + ':h=' + \
-            str(sizeY) + ':fps=' + str(fps) + \
-            ':type=jpg -ovc lavc -lavcopts vcodec=mpeg4 -o %s' % movieName
-    log(args)
-    os.system(program + args)
+        codec = 'vcodec=mpeg4'
+    return ['mencoder', '-', '-demuxer', 'rawvideo', '-rawvideo',
+            'w=%d:h=%d:fps=%s:format=rgb24' % (sizeX, sizeY, fps),
+            '-ovc', 'lavc', '-lavcopts', codec, '-o', movieName]
+
+
+def startEncoder(sizeX, sizeY, fps, movieName, format):
+    """
+    Starts the encoder process. Frames are written to it by encodeFrames()
+    and the movie is completed by finishEncoder().
+    """
+    args = getEncoderArgs(sizeX, sizeY, fps, movieName, format)
+    log(" ".join(args))
+    return subprocess.Popen(args, stdin=subprocess.PIPE)
+
+
+def imageToBytes(image):
+    """ Returns the raw RGB data of the PIL image """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+
+def writeFrame(frames, image, count=1):
+    """
+    Queues the PIL image to be encoded as the next frame, repeated count
+    times. The data is copied, so the image can be reused for the next
+    frame.
+    """
+    frames.put((imageToBytes(image), count))
+
+
+def encodeFrames(encoder, frames, errors):
+    """
+    Writes the frames from the queue to the encoder until None is received.
+    Each frame is written as many times as it was queued for. Any error is
+    added to errors and the remaining frames are discarded, so that
+    writeFrame() is never blocked.
+    """
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        data, count = frame
+        try:
+            for i in range(count):
+                if errors:
+                    break
+                encoder.stdin.write(data)
+        except IOError, e:
+            errors.append(e)
+
+
+def finishEncoder(encoder):
+    """
+    Closes the encoder input and waits for the movie to be written.
+
+    @return:        The exit status of the encoder, 0 on success
+    """
+    try:
+        encoder.stdin.close()
+    except IOError:
+        # encoder has already exited
+        pass
+    return encoder.wait()
 
 
 def rangeFromList(list, index):
@@ -169,42 +230,74 @@ def rangeFromList(list, index):
 
 
 def calculateAquisitionTime(conn, pixelsId, cList, tzList):
-    """ Loads the plane information. """
+    """
+    Loads the plane information, a page of PLANE_INFO_PAGE_SIZE planes at a
+    time, with a parameterized query over the C, Z and T ranges.
+
+    @return:        (times, tStart, zStart) where times is a (T, Z) array of
+                    the deltaT of each plane averaged over the channels, NaN
+                    if unknown. The time of (t, z) is
+                    times[t - tStart, z - zStart]. None if there is no
+                    plane information or a plane has no deltaT.
+    """
     queryService = conn.getQueryService()
 
-    tRange = ",".join([str(i) for i in rangeFromList(tzList, 0)])
-    zRange = ",".join([str(i) for i in rangeFromList(tzList, 1)])
-    cRange = ",".join([str(i) for i in cList])
-    query = "from PlaneInfo as Info where Info.theZ in (%s) and Info.theT" \
-        " in (%s) and Info.theC in (%s) and pixels.id='%s'" \
-        % (zRange, tRange, cRange, pixelsId)
-    infoList = queryService.findAllByQuery(query, None)
-
-    map = {}
-    for info in infoList:
-        if (info.deltaT is None):
-            return None
-        key = "z:" + str(info.theZ.getValue()) + "t:" + \
-            str(info.theT.getValue())
-        if key in map:
-            value = map.get(key)
-            value = value+info.deltaT.getValue()
-            map[key] = value
-        else:
-            map[key] = info.deltaT.getValue()
-    for key in map:
-        map[key] = map[key]/len(cRange)
-    return map
-
-
-def addScalebar(scalebar, image, pixels, commandArgs):
-    """ Adds the scalebar. """
+    tRange = rangeFromList(tzList, 0)
+    zRange = rangeFromList(tzList, 1)
+    params = omero.sys.ParametersI()
+    params.addId(pixelsId)
+    params.add("cs", rlist([rint(c) for c in cList]))
+    params.add("zStart", rint(zRange[0]))
+    params.add("zEnd", rint(zRange[-1]))
+    params.add("tStart", rint(tRange[0]))
+    params.add("tEnd", rint(tRange[-1]))
+    query = "from PlaneInfo as Info where Info.pixels.id = :id "\
+        "and Info.theC in (:cs) and Info.theZ >= :zStart "\
+        "and Info.theZ <= :zEnd and Info.theT >= :tStart "\
+        "and Info.theT <= :tEnd order by Info.id"
+
+    tIndexes = []
+    zIndexes = []
+    deltaTs = []
+    offset = 0
+    while True:
+        params.page(offset, PLANE_INFO_PAGE_SIZE)
+        infoList = queryService.findAllByQuery(query, params,
+                                               conn.SERVICE_OPTS)
+        for info in infoList:
+            if (info.deltaT is None):
+                return None
+            tIndexes.append(info.theT.getValue() - tRange[0])
+            zIndexes.append(info.theZ.getValue() - zRange[0])
+            deltaTs.append(info.deltaT.getValue())
+        if len(infoList) < PLANE_INFO_PAGE_SIZE:
+            break
+        offset += PLANE_INFO_PAGE_SIZE
+    if not deltaTs:
+        return None
+
+    shape = (len(tRange), len(zRange))
+    times = numpy.zeros(shape)
+    counts = numpy.zeros(shape)
+    numpy.add.at(times, (tIndexes, zIndexes), deltaTs)
+    numpy.add.at(counts, (tIndexes, zIndexes), 1)
+    known = counts > 0
+    times[known] /= counts[known]
+    times[~known] = numpy.nan
+    return times, tRange[0], zRange[0]
+
+
+def addScalebar(scalebar, image, pixels, commandArgs, scale=1.0):
+    """
+    Adds the scalebar. Scale is the size of the image pixels relative to
+    the pixels of the original image, E.g. 0.5 if downscaled by half.
+    """
     image_w, image_h = image.size
     draw = ImageDraw.Draw(image)
     if (pixels.getPhysicalSizeX() is None):
         return image
     # FIXME: units ignored for now
-    pixelSizeX = pixels.getPhysicalSizeX().getValue()
+    pixelSizeX = pixels.getPhysicalSizeX().getValue() / scale
     if (pixelSizeX <= 0):
         return image
     scaleBarY = image_h-30
@@ -221,24 +314,31 @@ def addScalebar(scalebar, image, pixels, commandArgs):
     return image
 
 
-def addPlaneInfo(z, t, pixels, image, colour):
-    """ Displays the plane information. """
+def addPlaneInfo(z, t, pixels, image, colour, draw=None, zEnd=None):
+    """
+    Displays the plane information. If zEnd is specified, shows the Z range
+    z - zEnd of a projection.
+    """
     image_w, image_h = image.size
-    draw = ImageDraw.Draw(image)
+    if draw is None:
+        draw = ImageDraw.Draw(image)
     planeInfoTextY = image_h-60
     textX = 20
     if(planeInfoTextY <= 0 or textX > image_w or planeInfoTextY > image_h):
         return image
     planeCoord = "z:"+str(z+1)+" t:"+str(t+1)
+    if zEnd is not None:
+        planeCoord = "z:"+str(z+1)+"-"+str(zEnd+1)+" t:"+str(t+1)
     draw.text((textX, planeInfoTextY), planeCoord, fill=colour)
     return image
 
 
-def addTimePoints(time, pixels, image, colour):
+def addTimePoints(time, pixels, image, colour, draw=None):
     """ Displays the time-points as hrs:mins:secs """
     time = figureUtil.formatTime(time, "HOURS_MINS_SECS")
     image_w, image_h = image.size
-    draw = ImageDraw.Draw(image)
+    if draw is None:
+        draw = ImageDraw.Draw(image)
     textY = image_h-45
     textX = 20
     if(textY <= 0 or textX > image_w or textY > image_h):
@@ -266,17 +366,183 @@ def getRenderingEngine(conn, pixelsId, sizeC, cRange):
     return renderingEngine
 
 
-def getPlane(renderingEngine, z, t):
-    """ Retrieves the specified XY-plane. """
+def getPlane(renderingEngine, z, t, region=None):
+    """
+    Retrieves the specified XY-plane, or only the (x, y, width, height)
+    region of it.
+    """
     planeDef = omero.romio.PlaneDef()
     planeDef.t = t
     planeDef.z = z
     planeDef.x = 0
     planeDef.y = 0
     planeDef.slice = 0
+    if region is not None:
+        planeDef.region = omero.romio.RegionDef(*region)
     return renderingEngine.renderAsPackedInt(planeDef)
 
 
+def getRenderRegion(renderingEngine, imageSize, region, maxWidth,
+                    maxHeight):
+    """
+    Works out how to render a region of the image to fit in maxWidth and
+    maxHeight, using the smallest resolution level of the pyramid (if any)
+    that is not smaller than the frames.
+
+    @param imageSize:   (sizeX, sizeY) of the full size image
+    @param region:      (x, y, width, height) of the full size image
+    @param maxWidth:    Max width of the frames. No limit if <= 0
+    @param maxHeight:   Max height of the frames. No limit if <= 0
+    @return:            (level, levelSize, levelRegion, scale): the
+                        resolution level to render (None for the default),
+                        the (sizeX, sizeY) of that level as rendered by the
+                        server, the region at that level and the size of
+                        the frames relative to the full size image
+    """
+    x, y, width, height = region
+    scale = 1.0
+    if maxWidth > 0:
+        scale = min(scale, float(maxWidth) / width)
+    if maxHeight > 0:
+        scale = min(scale, float(maxHeight) / height)
+
+    level = None
+    levelSize = imageSize
+    if scale < 1 and renderingEngine.requiresPixelsPyramid():
+        # descriptions are from the full size image to the smallest
+        descriptions = renderingEngine.getResolutionDescriptions()
+        for i, d in enumerate(descriptions):
+            if float(d.sizeX) / descriptions[0].sizeX < scale:
+                break
+            level = len(descriptions) - 1 - i
+            levelSize = (d.sizeX, d.sizeY)
+    # the levels may not be scaled by exactly the same in X and Y
+    scaleX = float(levelSize[0]) / imageSize[0]
+    scaleY = float(levelSize[1]) / imageSize[1]
+    levelX = min(int(x * scaleX), levelSize[0] - 1)
+    levelY = min(int(y * scaleY), levelSize[1] - 1)
+    levelRegion = (levelX, levelY,
+                   max(1, min(int(round(width * scaleX)),
+                              levelSize[0] - levelX)),
+                   max(1, min(int(round(height * scaleY)),
+                              levelSize[1] - levelY)))
+    return level, levelSize, levelRegion, scale
+
+
+def getProjectedPlane(renderingEngine, t, algorithm, zStart, zEnd):
+    """ Retrieves the projection of the Z range at the specified time-point """
+    return renderingEngine.renderProjectedAsPackedInt(
+        algorithm, t, 1, zStart, zEnd)
+
+
+def prepareRenderingEngine(image, rdid=-1):
+    """
+    Prepares the rendering engine of the image, with the rendering def rdid
+    if >= 0. Movies made at the same time would otherwise be able to get
+    the same (stateful) engine.
+    """
+    renderingEngineLock.acquire()
+    try:
+        if rdid >= 0:
+            image._prepareRenderingEngine(rdid=rdid)
+        else:
+            image._prepareRenderingEngine()
+    finally:
+        renderingEngineLock.release()
+
+
+def prepareRenderImage(conn, imageId, rdid, cRange, cWindows, cColours,
+                       level=None):
+    """
+    Returns the image with its own rendering engine, set up with the
+    channels and resolution level of the movie. Rendering engines are
+    stateful, so each render thread needs its own.
+    """
+    image = conn.getObject("Image", imageId)
+    prepareRenderingEngine(image, rdid)
+    image.setActiveChannels(map(lambda x: x+1, cRange), cWindows, cColours)
+    if level is not None:
+        image._re.setResolutionLevel(level)
+    return image
+
+
+def renderPlanes(images, tzList, maxAhead, renderPlane=getPlane):
+    """
+    Generator of (t, z, plane) for each [t, z] of tzList, in order.
+    Each of the images has its own rendering engine, used by its own render
+    thread, so that up to maxAhead planes are rendered while the previous
+    planes are being composited and encoded.
+
+    @param renderPlane:     Function(renderingEngine, z, t) returning the
+                            plane as packed ints
+    """
+    jobs = Queue.Queue()
+    for i, tz in enumerate(tzList):
+        jobs.put((i, tz))
+    slots = threading.Semaphore(maxAhead)
+    stopped = threading.Event()
+    ready = threading.Condition()
+    done = {}
+
+    def render(image):
+        while True:
+            slots.acquire()
+            if stopped.isSet():
+                return
+            try:
+                i, (t, z) = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                plane = renderPlane(image._re, z, t)
+            except Exception, e:
+                plane = e
+            ready.acquire()
+            try:
+                done[i] = plane
+                ready.notify()
+            finally:
+                ready.release()
+
+    threads = [threading.Thread(target=render, args=(image,))
+               for image in images]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for i, (t, z) in enumerate(tzList):
+            ready.acquire()
+            try:
+                while i not in done:
+                    ready.wait()
+                plane = done.pop(i)
+            finally:
+                ready.release()
+            slots.release()
+            if isinstance(plane, Exception):
+                raise plane
+            yield t, z, plane
+    finally:
+        # stop the render threads, E.g. if a frame failed
+        stopped.set()
+        for thread in threads:
+            slots.release()
+        for thread in threads:
+            thread.join()
+
+
+def packedToImage(packed, sizeX, sizeY):
+    """
+    Returns the ARGB ints from renderAsPackedInt as a PIL RGBA image.
+    The ints are converted to a numpy array in one pass (no copy if they
+    already are one) and their bytes are read by PIL in native byte order,
+    with no byte swapping or reshaping.
+    """
+    data = numpy.asarray(packed, dtype=numpy.int32)
+    return Image.frombuffer('RGBA', (sizeX, sizeY), data.data, 'raw',
+                            PACKED_INT_MODE, 0, 1)
+
+
 def inRange(low, high, max):
     """ Determines if the passed values are in the range. """
     if(low < 0 or low > high):
@@ -380,7 +646,7 @@ def reshape_to_fit(image, sizeX, sizeY, bg=(0, 0, 0)):
     print "scale...from ", image.size, " to ", sizeX, sizeY
     ratio = min(float(sizeX) / image_w, float(sizeY) / image_h)
     image = image.resize(map(lambda x: int(x*ratio), image.size),
-                         Image.ANTIALIAS)
+                         ANTIALIAS)
     print ratio, image.size
     # paste
     bg = Image.new("RGBA", (sizeX, sizeY), (0, 0, 0))     # black bg
@@ -391,7 +657,7 @@ def reshape_to_fit(image, sizeX, sizeY, bg=(0, 0, 0)):
 
 
 def write_intro_end_slides(conn, commandArgs, orig_file_id, duration, sizeX,
-                           sizeY):
+                           sizeY, frames):
     """
     Uses an original file (jpeg or png) to add frames to the movie.
     Scales and pads to fit sizeX, sizeY.
@@ -400,12 +666,10 @@ def write_intro_end_slides(conn, commandArgs, orig_file_id, duration, sizeX,
     @param duration:        Duration of intro / end (secs)
     @param sizeX:           Width of the exported movie
     @param sizeY:           Height of the exported movie
-    @return:                List of file names to add to mencoder list
+    @param frames:          The queue of frames to encode
     """
 
-    slide_filenames = []
     fps = commandArgs["FPS"]
-    format = commandArgs["Format"]
 
     # get Original File as Image
     slide_file = conn.getObject("OriginalFile", orig_file_id)
@@ -414,18 +678,8 @@ def write_intro_end_slides(conn, commandArgs, orig_file_id, duration, sizeX,
     slide = Image.open(i)
     slide = reshape_to_fit(slide, sizeX, sizeY)
 
-    # write the file once
-    if format == QT:
-        filename = 'slide_%s.png' % orig_file_id
-        slide.save(filename, "PNG")
-    else:
-        filename = 'slide_%s.jpg' % orig_file_id
-        slide.save(filename, "JPEG")
-    # control duration by adding the filename multiple times
-    for i in range(duration * fps):
-        slide_filenames.append(filename)
-
-    return slide_filenames
+    # control duration by repeating the slide, converted and queued once
+    writeFrame(frames, slide, duration * fps)
 
 
 def prepareWatermark(conn, commandArgs, sizeX, sizeY):
@@ -450,23 +704,36 @@ def prepareWatermark(conn, commandArgs, sizeX, sizeY):
     return wm
 
 
-def pasteWatermark(image, watermark):
-    """
-    Paste the watermark onto the bottom left corner of the image. Return image
+def makeOverlay(commandArgs, pixels, sizeX, sizeY, watermark=None,
+                scale=1.0):
     """
+    Draws the overlays that are the same on every frame (watermark and
+    scalebar) once, on a transparent layer, so they are only pasted onto
+    each frame.
 
-    wm_w, wm_h = watermark.size
-    w, h = image.size
-    wmpos = 0, h - wm_h
-    image.paste(watermark, wmpos, watermark)
-    return image
+    @return:        The layer cropped to the drawn area and its position,
+                    or (None, None) if there is nothing to draw
+    """
+    overlay = Image.new("RGBA", (sizeX, sizeY), (0, 0, 0, 0))
+    if watermark is not None:
+        watermark = watermark.convert("RGBA")
+        overlay.paste(watermark, (0, sizeY - watermark.size[1]))
+    if "Scalebar" in commandArgs and commandArgs["Scalebar"]:
+        addScalebar(commandArgs["Scalebar"], overlay, pixels, commandArgs,
+                    scale)
+    box = overlay.getbbox()
+    if box is None:
+        return None, None
+    return overlay.crop(box), box[:2]
 
 
 def writeMovie(commandArgs, conn):
     """
-    Makes the movie.
+    Makes a movie for each of the images, running up to Concurrent_Movies
+    at the same time, in a single session.
 
-    @ returns        Returns the file annotation
+    @ returns        Returns the list of file annotations (or original files
+                     if not Do_Link) and the message
     """
     log("Movie created by OMERO")
     log("")
@@ -481,14 +748,92 @@ def writeMovie(commandArgs, conn):
     images, logMessage = scriptUtil.getObjects(conn, commandArgs)
     message += logMessage
     if not images:
-        return None, message
-    # Get the first valid image (should be expanded to process the list)
-    omeroImage = images[0]
+        return [], message
+
+    maxMovies = 1
+    if "Concurrent_Movies" in commandArgs:
+        maxMovies = max(1, commandArgs["Concurrent_Movies"])
+    todo = Queue.Queue()
+    for omeroImage in images:
+        todo.put(omeroImage)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                omeroImage = todo.get_nowait()
+            except Queue.Empty:
+                return
+            suffix = ""
+            if len(images) > 1:
+                suffix = "_%s" % omeroImage.getId()
+            try:
+                # each movie may change its own copy of the arguments
+                result = makeMovie(conn, dict(commandArgs), omeroImage,
+                                   updateService, rawFileStore, suffix)
+            except Exception, e:
+                log("Failed to make movie for Image %s: %s"
+                    % (omeroImage.getId(), e))
+                result = (None, "Failed to make movie for Image %s. "
+                          % omeroImage.getId())
+            results[omeroImage.getId()] = result
+
+    workers = [threading.Thread(target=worker)
+               for i in range(min(maxMovies, len(images)))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    rawFileStore.close()
+
+    movies = []
+    for omeroImage in images:
+        movie, movieMessage = results[omeroImage.getId()]
+        if len(images) > 1 and movie is not None:
+            # a short message per movie if there are many
+            movieMessage = ""
+        message += movieMessage
+        if movie is not None:
+            movies.append(movie)
+    if len(images) > 1:
+        message += "%d of %d movies created." % (len(movies), len(images))
+    return movies, message
+
+
+def getRenderingDefId(conn, rdid, pixelsId):
+    """
+    Returns rdid if it is the ID of a rendering def of the pixels,
+    otherwise -1.
+    """
+    if rdid < 0:
+        return -1
+    params = omero.sys.ParametersI()
+    params.addId(rdid)
+    params.addLong("pid", pixelsId)
+    query = "select r.id from RenderingDef r where r.id = :id "\
+        "and r.pixels.id = :pid"
+    if conn.getQueryService().projection(query, params, conn.SERVICE_OPTS):
+        return rdid
+    return -1
+
+
+def makeMovie(conn, commandArgs, omeroImage, updateService, rawFileStore,
+              suffix=""):
+    """
+    Makes the movie of a single image.
+
+    @param suffix:   Added to the movie name, E.g. when making many movies
+    @ returns        Returns the file annotation (or original file if not
+                     Do_Link) and the message
+    """
+    message = ""
 
-    if commandArgs["RenderingDef_ID"] >= 0:
-        omeroImage._prepareRenderingEngine(rdid=commandArgs["RenderingDef_ID"])
     pixels = omeroImage.getPrimaryPixels()
     pixelsId = pixels.getId()
+    # the rendering def is only used for the image it belongs to, other
+    # images use their own settings
+    rdid = getRenderingDefId(conn, commandArgs["RenderingDef_ID"], pixelsId)
+    prepareRenderingEngine(omeroImage, rdid)
 
     sizeX = pixels.getSizeX()
     sizeY = pixels.getSizeY()
@@ -498,7 +843,7 @@ def writeMovie(commandArgs, conn):
 
     if (sizeX is None or sizeY is None or sizeZ is None or sizeT is None or
             sizeC is None):
-        return
+        return None, "Image %s has no size. " % omeroImage.getId()
 
     if (pixels.getPhysicalSizeX() is None):
         commandArgs["Scalebar"] = 0
@@ -524,18 +869,66 @@ def writeMovie(commandArgs, conn):
 
     tzList = calculateRanges(sizeZ, sizeT, commandArgs)
 
-    timeMap = calculateAquisitionTime(conn, pixelsId, cRange, tzList)
-    if (timeMap is None):
-        commandArgs["Show_Time"] = False
-    if (timeMap is not None):
-        if (len(timeMap) == 0):
-            commandArgs["Show_Time"] = False
-
-    frameNo = 1
     omeroImage.setActiveChannels(map(lambda x: x+1, cRange),
                                  cWindows,
                                  cColours)
-    renderingEngine = omeroImage._re
+
+    # the region of the image to show, and the size of the frames
+    regionX = min(max(0, commandArgs.get("Region_X", 0)), sizeX - 1)
+    regionY = min(max(0, commandArgs.get("Region_Y", 0)), sizeY - 1)
+    regionW = sizeX - regionX
+    if commandArgs.get("Region_Width", 0) > 0:
+        regionW = min(regionW, commandArgs["Region_Width"])
+    regionH = sizeY - regionY
+    if commandArgs.get("Region_Height", 0) > 0:
+        regionH = min(regionH, commandArgs["Region_Height"])
+    level, levelSize, levelRegion, scale = getRenderRegion(
+        omeroImage._re, (sizeX, sizeY), (regionX, regionY, regionW, regionH),
+        commandArgs.get("Max_Width", -1), commandArgs.get("Max_Height", -1))
+    if level is not None:
+        omeroImage._re.setResolutionLevel(level)
+    frameW = max(1, int(regionW * scale))
+    frameH = max(1, int(regionH * scale))
+    region = None
+    if levelRegion != (0, 0) + tuple(levelSize):
+        region = levelRegion
+    # size of the rendered planes
+    planeW, planeH = levelRegion[2:]
+
+    # project the Z range of each time-point into a single frame?
+    def getRegionPlane(renderingEngine, z, t):
+        return getPlane(renderingEngine, z, t, region)
+    renderPlane = getRegionPlane
+    cropBox = None
+    zEnd = None
+    projection = "Projection" in commandArgs and \
+        commandArgs["Projection"] in projectionTypes and \
+        "Plane_Map" not in commandArgs
+    if projection:
+        algorithm = projectionTypes[commandArgs["Projection"]]
+        zs = rangeFromList(tzList, 1)
+        zStart = zs[0]
+        zEnd = zs[-1]
+        tzList = [[t, zStart] for t in rangeFromList(tzList, 0)]
+
+        def renderPlane(renderingEngine, z, t):
+            return getProjectedPlane(renderingEngine, t, algorithm, zStart,
+                                     zEnd)
+        # projections are of the whole plane, so crop the region
+        if region is not None:
+            x, y, w, h = region
+            cropBox = (x, y, x + w, y + h)
+            planeW, planeH = levelSize
+
+    timeMap = calculateAquisitionTime(conn, pixelsId, cRange, tzList)
+    if (timeMap is None):
+        commandArgs["Show_Time"] = False
+    else:
+        times, timesT0, timesZ0 = timeMap
+    renderImages = [omeroImage]
+    workers = 1
+    if "Render_Workers" in commandArgs:
+        workers = max(1, commandArgs["Render_Workers"])
 
     overlayColour = (255, 255, 255)
     if "Overlay_Colour" in commandArgs:
@@ -544,103 +937,137 @@ def writeMovie(commandArgs, conn):
 
     canvasColour = tuple(COLOURS[commandArgs["Canvas_Colour"]][:3])
     mw = commandArgs["Min_Width"]
-    if mw < sizeX:
-        mw = sizeX
+    if mw < frameW:
+        mw = frameW
     mh = commandArgs["Min_Height"]
-    if mh < sizeY:
-        mh = sizeY
-    ovlpos = None
-    canvas = None
-    if sizeX < mw or sizeY < mh:
-        ovlpos = ((mw-sizeX) / 2, (mh-sizeY) / 2)
-        canvas = Image.new("RGBA", (mw, mh), canvasColour)
+    if mh < frameH:
+        mh = frameH
+    ovlpos = (0, 0)
+    if frameW < mw or frameH < mh:
+        ovlpos = ((mw-frameW) / 2, (mh-frameH) / 2)
 
     format = commandArgs["Format"]
-    fileNames = []
-
-    # add intro...
-    if "Intro_Slide" in commandArgs and commandArgs["Intro_Slide"].id:
-        intro_duration = commandArgs["Intro_Duration"]
-        intro_fileId = commandArgs["Intro_Slide"].id.val
-        intro_filenames = write_intro_end_slides(
-            conn, commandArgs, intro_fileId, intro_duration, mw, mh)
-        fileNames.extend(intro_filenames)
-
-    # prepare watermark
-    if "Watermark" in commandArgs and commandArgs["Watermark"].id:
-        watermark = prepareWatermark(conn, commandArgs, mw, mh)
-
-    # add movie frames...
-    for tz in tzList:
-        t = tz[0]
-        z = tz[1]
-        plane = getPlane(renderingEngine, z, t)
-        planeImage = numpy.array(plane, dtype='uint32')
-        planeImage = planeImage.byteswap()
-        planeImage = planeImage.reshape(sizeX, sizeY)
-        image = Image.frombuffer('RGBA', (sizeX, sizeY), planeImage.data,
-                                 'raw', 'ARGB', 0, 1)
-        if ovlpos is not None:
-            image2 = canvas.copy()
-            image2.paste(image, ovlpos, image)
-            image = image2
-
-        if "Scalebar" in commandArgs and commandArgs["Scalebar"]:
-            image = addScalebar(
-                commandArgs["Scalebar"], image, pixels, commandArgs)
-        planeInfo = "z:"+str(z)+"t:"+str(t)
-        if "Show_Time" in commandArgs and commandArgs["Show_Time"]:
-            time = timeMap[planeInfo]
-            image = addTimePoints(time, pixels, image, overlayColour)
-        if "Show_Plane_Info" in commandArgs and \
-                commandArgs["Show_Plane_Info"]:
-            image = addPlaneInfo(z, t, pixels, image, overlayColour)
-        if "Watermark" in commandArgs and commandArgs["Watermark"].id:
-            image = pasteWatermark(image, watermark)
-        if format == QT:
-            filename = str(frameNo) + '.png'
-            image.save(filename, "PNG")
-        else:
-            filename = str(frameNo) + '.jpg'
-            image.save(filename, "JPEG")
-        fileNames.append(filename)
-        frameNo += 1
-
-    # add exit frames... "outro"
-    # add intro...
-    if "Ending_Slide" in commandArgs and commandArgs["Ending_Slide"].id:
-        end_duration = commandArgs["Ending_Duration"]
-        end_fileId = commandArgs["Ending_Slide"].id.val
-        end_filenames = write_intro_end_slides(
-            conn, commandArgs, end_fileId, end_duration, mw, mh)
-        fileNames.extend(end_filenames)
-
-    filelist = ",".join(fileNames)
-
     ext = formatMap[format]
     movieName = "Movie"
     if "Movie_Name" in commandArgs:
         movieName = commandArgs["Movie_Name"]
         movieName = os.path.basename(movieName)
-    if not movieName.endswith(".%s" % ext):
-        movieName = "%s.%s" % (movieName, ext)
+    if movieName.endswith(".%s" % ext):
+        movieName = movieName[:-(len(ext)+1)]
+    movieName = "%s%s.%s" % (movieName, suffix, ext)
 
     # spaces etc in file name cause problems
     movieName = re.sub("[$&\;|\(\)<>' ]", "", movieName)
     framesPerSec = 2
     if "FPS" in commandArgs:
         framesPerSec = commandArgs["FPS"]
-    output = "localfile.%s" % ext
-    buildAVI(mw, mh, filelist, framesPerSec, output, format)
+    output = "localfile_%s.%s" % (omeroImage.getId(), ext)
     mimetype = formatMimetypes[format]
 
-    if not os.path.exists(output):
-        print "mencoder Failed to create movie file: %s" % output
+    # prepare watermark and scalebar
+    watermark = None
+    if "Watermark" in commandArgs and commandArgs["Watermark"].id:
+        watermark = prepareWatermark(conn, commandArgs, mw, mh)
+    overlay, overlayPos = makeOverlay(commandArgs, pixels, mw, mh, watermark,
+                                      scale)
+
+    # frames are piped to the encoder, by its own thread, as they are made
+    try:
+        encoder = startEncoder(mw, mh, framesPerSec, output, format)
+    except OSError, e:
+        print "Failed to start mencoder: %s" % e
+        return None, "Failed to start the movie encoder"
+    frames = Queue.Queue(FRAME_QUEUE_SIZE)
+    errors = []
+    encoderThread = threading.Thread(target=encodeFrames,
+                                     args=(encoder, frames, errors))
+    encoderThread.start()
+    planes = None
+    try:
+        # more images with their own rendering engines for more render
+        # threads
+        for i in range(1, min(workers, len(tzList))):
+            renderImages.append(prepareRenderImage(
+                conn, omeroImage.getId(), rdid, cRange, cWindows, cColours,
+                level))
+
+        # add intro... (errors means the encoder has failed: stop there)
+        if not errors and "Intro_Slide" in commandArgs and \
+                commandArgs["Intro_Slide"].id:
+            intro_duration = commandArgs["Intro_Duration"]
+            intro_fileId = commandArgs["Intro_Slide"].id.val
+            write_intro_end_slides(conn, commandArgs, intro_fileId,
+                                   intro_duration, mw, mh, frames)
+
+        # add movie frames, rendered ahead by the render threads...
+        # Each frame is made in the same buffer, on the canvas background.
+        # The border around the image is refilled with the canvas colour
+        # for each frame, clearing the text and overlay of the last frame.
+        frame = Image.new("RGB", (mw, mh), canvasColour)
+        draw = ImageDraw.Draw(frame)
+        x, y = ovlpos
+        border = [box for box in ((0, 0, mw, y), (0, y + frameH, mw, mh),
+                                  (0, y, x, y + frameH),
+                                  (x + frameW, y, mw, y + frameH))
+                  if box[0] < box[2] and box[1] < box[3]]
+        planes = renderPlanes(renderImages, tzList, 2 * workers, renderPlane)
+        for t, z, plane in planes:
+            if errors:
+                # the encoder has failed, so don't render any more frames
+                break
+            for box in border:
+                frame.paste(canvasColour, box)
+            image = packedToImage(plane, planeW, planeH)
+            if cropBox is not None:
+                image = image.crop(cropBox)
+            if image.size != (frameW, frameH):
+                image = image.resize((frameW, frameH), ANTIALIAS)
+            frame.paste(image, ovlpos)
+
+            if "Show_Time" in commandArgs and commandArgs["Show_Time"]:
+                time = times[t - timesT0, z - timesZ0]
+                if not numpy.isnan(time):
+                    addTimePoints(time, pixels, frame, overlayColour, draw)
+            if "Show_Plane_Info" in commandArgs and \
+                    commandArgs["Show_Plane_Info"]:
+                addPlaneInfo(z, t, pixels, frame, overlayColour, draw, zEnd)
+            if overlay is not None:
+                frame.paste(overlay, overlayPos, overlay)
+            writeFrame(frames, frame)
+
+        # add exit frames... "outro"
+        if not errors and "Ending_Slide" in commandArgs and \
+                commandArgs["Ending_Slide"].id:
+            end_duration = commandArgs["Ending_Duration"]
+            end_fileId = commandArgs["Ending_Slide"].id.val
+            write_intro_end_slides(conn, commandArgs, end_fileId,
+                                   end_duration, mw, mh, frames)
+    finally:
+        # stop the render threads before their engines are closed
+        if planes is not None:
+            planes.close()
+        frames.put(None)
+        encoderThread.join()
+        status = finishEncoder(encoder)
+        for renderImage in renderImages[1:]:
+            renderImage._re.close()
+    if errors:
+        # the encoder closed its input, E.g. it failed to start
+        log("Failed to write frame to encoder: %s" % errors[0])
+
+    if status != 0 or not os.path.exists(output):
+        print "mencoder Failed to create movie file: %s (exit status %s)" \
+            % (output, status)
         return None, "Failed to create movie file: %s" % output
     if not commandArgs["Do_Link"]:
         originalFile = scriptUtil.createFile(
             updateService, output, mimetype, movieName)
-        scriptUtil.uploadFile(rawFileStore, originalFile, movieName)
+        # the raw file store is shared by all the movies
+        uploadLock.acquire()
+        try:
+            scriptUtil.uploadFile(rawFileStore, originalFile, output)
+        finally:
+            uploadLock.release()
         return originalFile, message
 
     namespace = NSCREATED + "/omero/export_scripts/Make_Movie"
@@ -665,6 +1092,7 @@ def runAsScript():
     ckeys.sort()
     cOptions = wrap(ckeys)
     dataTypes = [rstring("Image")]
+    projections = wrap([NO_PROJECTION] + sorted(projectionTypes.keys()))
 
     client = scripts.client(
         'Make_Movie',
@@ -678,11 +1106,14 @@ def runAsScript():
 
         scripts.List(
             "IDs", optional=False, grouping="1",
-            description="List of Image IDs to process.").ofType(rlong(0)),
+            description="List of Image IDs to process. A movie is made for"
+            " each image.").ofType(rlong(0)),
 
         scripts.Long(
             "RenderingDef_ID",
-            description="The Rendering Definitions for the Image.",
+            description="The Rendering Definitions for the Image. Only"
+            " used for the image it belongs to, other images use their own"
+            " rendering settings.",
             default=-1, optional=True, grouping="1"),
 
         scripts.String(
@@ -690,13 +1121,19 @@ def runAsScript():
 
         scripts.Int(
             "Z_Start",
-            description="Projection range (if not specified, use defaultZ"
-            " only - no projection)", min=0, default=0, grouping="3.1"),
+            description="The first Z-section (or start of the projection"
+            " range)", min=0, default=0, grouping="3.1"),
 
         scripts.Int(
             "Z_End",
-            description="Projection range (if not specified or, use defaultZ"
-            " only - no projection)", min=0, grouping="3.2"),
+            description="The last Z-section (or end of the projection"
+            " range)", min=0, grouping="3.2"),
+
+        scripts.String(
+            "Projection",
+            description="Make one frame per time-point by projecting"
+            " Z_Start to Z_End. Not used with Plane_Map.",
+            values=projections, default=NO_PROJECTION, grouping="3.3"),
 
         scripts.Int(
             "T_Start",
@@ -731,6 +1168,15 @@ def runAsScript():
         scripts.Int(
             "FPS", description="Frames Per Second.", default=2, grouping="8"),
 
+        scripts.Int(
+            "Concurrent_Movies", default=1, min=1, grouping="8.2",
+            description="Number of movies made at the same time when"
+            " several Image IDs are given."),
+
+        scripts.Int(
+            "Render_Workers", default=2, min=1, grouping="8.1",
+            description="Number of frames rendered at the same time."),
+
         scripts.Int(
             "Scalebar",
             description="Scale bar size in microns. Only shown if image has"
@@ -758,6 +1204,34 @@ def runAsScript():
             "Min_Height",
             description="Minimum height for output movie.", default=-1),
 
+        scripts.Int(
+            "Max_Width",
+            description="Maximum width for output movie. The image is scaled"
+            " down to fit.", default=-1),
+
+        scripts.Int(
+            "Max_Height",
+            description="Maximum height for output movie. The image is"
+            " scaled down to fit.", default=-1),
+
+        scripts.Int(
+            "Region_X", grouping="13.1", min=0, default=0,
+            description="Left of the region of the image to show."),
+
+        scripts.Int(
+            "Region_Y", grouping="13.2", min=0, default=0,
+            description="Top of the region of the image to show."),
+
+        scripts.Int(
+            "Region_Width", grouping="13.3", min=0,
+            description="Width of the region of the image to show. Default"
+            " is to the right of the image."),
+
+        scripts.Int(
+            "Region_Height", grouping="13.4", min=0,
+            description="Height of the region of the image to show. Default"
+            " is to the bottom of the image."),
+
         scripts.Map(
             "Plane_Map",
             description="Specify the individual planes (instead of using"
@@ -805,12 +1279,15 @@ def runAsScript():
         commandArgs = client.getInputs(unwrap=True)
         print commandArgs
 
-        fileAnnotation, message = writeMovie(commandArgs, conn)
+        movies, message = writeMovie(commandArgs, conn)
 
-        # return this fileAnnotation to the client.
+        # return the fileAnnotations to the client.
         client.setOutput("Message", rstring(message))
-        if fileAnnotation is not None:
-            client.setOutput("File_Annotation", robject(fileAnnotation))
+        if movies:
+            client.setOutput("File_Annotation", robject(movies[0]))
+        if len(movies) > 1:
+            client.setOutput("File_Annotations",
+                             rlist([robject(m) for m in movies]))
     finally:
         client.closeSession()
 
@@ -40,8 +40,63 @@ from omero.gateway import BlitzGateway
 import omero.scripts as scripts
 from omero.rtypes import rlong, rstring, robject
 import omero.util.script_utils as script_utils
+import omero.util.pixelstypetopython as pixelstypetopython
 
-from numpy import zeros, hstack, vstack
+from numpy import zeros, empty, rint, dtype
+from math import floor
+
+
+def shiftPlane(plane, out, x, y):
+    """
+    Writes the numpy 2D array into out (of the same shape), shifted by whole
+    pixels x and y, filling the uncovered rows and columns with 0.
+    """
+    height, width = plane.shape
+    if abs(x) >= width or abs(y) >= height:
+        out[:] = 0
+        return out
+    out[max(0, y):height + min(0, y), max(0, x):width + min(0, x)] = \
+        plane[max(0, -y):height - max(0, y), max(0, -x):width - max(0, x)]
+    if y > 0:
+        out[:y] = 0
+    elif y < 0:
+        out[y:] = 0
+    if x > 0:
+        out[:, :x] = 0
+    elif x < 0:
+        out[:, x:] = 0
+    return out
+
+
+def offsetPlane(plane, x, y, out, work=None):
+    """
+    Writes the numpy 2D array into out, offset by x and y, filling the
+    uncovered rows and columns with 0. Fractional offsets are interpolated
+    (bilinear) from the 4 nearest whole pixel offsets, using the float
+    arrays (sum, weighted) of work, which are the same shape as plane.
+
+    @return:    out
+    """
+    x0 = int(floor(x))
+    y0 = int(floor(y))
+    fx = x - x0
+    fy = y - y0
+    if fx == 0 and fy == 0:
+        return shiftPlane(plane, out, x0, y0)
+    total, weighted = work
+    total[:] = 0
+    for dx, dy, weight in ((x0, y0, (1 - fx) * (1 - fy)),
+                           (x0 + 1, y0, fx * (1 - fy)),
+                           (x0, y0 + 1, (1 - fx) * fy),
+                           (x0 + 1, y0 + 1, fx * fy)):
+        if weight > 0:
+            shiftPlane(plane, weighted, dx, dy)
+            weighted *= weight
+            total += weighted
+    if out.dtype.kind in 'iub':
+        rint(total, total)
+    out[:] = total
+    return out
 
 
 def newImageWithChannelOffsets(conn, imageId, channel_offsets, dataset=None):
@@ -98,69 +153,39 @@ def newImageWithChannelOffsets(conn, imageId, channel_offsets, dataset=None):
             channelList.append(cIndex)
             offsetMap[cIndex] = {'x': c['x'], 'y': c['y'], 'z': c['z']}
 
-    def offsetPlane(plane, x, y):
-        """
-        Takes a numpy 2D array and returns the same plane offset by x and y,
-        adding rows and columns of 0 values
-        """
-        height, width = plane.shape
-        dataType = plane.dtype
-        # shift x by cropping, creating a new array of columns and stacking
-        # horizontally
-        if abs(x) > 0:
-            newCols = zeros((height, abs(x)), dataType)
-            x1 = max(0, 0-x)
-            x2 = min(width, width-x)
-            crop = plane[0:height, x1:x2]
-            if x > 0:
-                plane = hstack((newCols, crop))
-            else:
-                plane = hstack((crop, newCols))
-        # shift y by cropping, creating a new array of rows and stacking
-        # vertically
-        if abs(y) > 0:
-            newRows = zeros((abs(y), width), dataType)
-            y1 = max(0, 0-y)
-            y2 = min(height, height-y)
-            crop = plane[y1:y2, 0:width]
-            if y > 0:
-                plane = vstack((newRows, crop))
-            else:
-                plane = vstack((crop, newRows))
-        return plane
+    # planes that are offset out of the Z range are black, so we only
+    # download the planes that are in range
+    inRange = [zct for zct in zctList if 0 <= zct[0] < sizeZ]
+    planeDtype = dtype(pixelstypetopython.toPython(oldImage.getPixelsType()))
 
     def offsetPlaneGen():
+        """
+        Yields the offset planes. Each plane is written into the same
+        buffer, so it is only valid until the next plane is requested.
+        """
         pixels = oldImage.getPrimaryPixels()
-        dt = None
-        # get the planes one at a time - exceptions on getPlane() don't affect
-        # subsequent calls (new RawPixelsStore)
-        for i in range(len(zctList)):
-            z, c, t = zctList[i]
+        # all the planes are read with the same RawPixelsStore
+        planes = pixels.getPlanes(inRange)
+        blackPlane = None
+        out = empty((sizeY, sizeX), planeDtype)
+        # float buffers are only needed to interpolate fractional offsets
+        work = None
+        if [o for o in offsetMap.values()
+                if o['x'] != floor(o['x']) or o['y'] != floor(o['y'])]:
+            work = (empty((sizeY, sizeX)), empty((sizeY, sizeX)))
+        for zct in zctList:
+            z, c, t = zct
             offsets = offsetMap[c]
             if z < 0 or z >= sizeZ:
-                print "Black plane for zct:", zctList[i]
-                if dt is None:
-                    # if we are on our first plane, we don't know datatype
-                    # yet...
-                    dt = pixels.getPlane(0, 0, 0).dtype
-                    # hack! TODO: add method to pixels to supply dtype
-                plane = zeros((sizeY, sizeX), dt)
+                print "Black plane for zct:", zct
+                if blackPlane is None:
+                    blackPlane = zeros((sizeY, sizeX), planeDtype)
+                yield blackPlane
             else:
-                print "getPlane for zct:", zctList[i], "applying offsets:", \
-                    offsets
-                try:
-                    plane = pixels.getPlane(*zctList[i])
-                    dt = plane.dtype
-                except:
-                    # E.g. the Z-index is out of range - Simply supply an
-                    # array of zeros.
-                    if dt is None:
-                        # if we are on our first plane, we don't know datatype
-                        # yet...
-                        dt = pixels.getPlane(0, 0, 0).dtype
-                        # hack! TODO: add method to pixels to supply dtype
-                    plane = zeros((sizeY, sizeX), dt)
-            yield offsetPlane(plane, offsets['x'], offsets['y'])
+                print "getPlane for zct:", zct, "applying offsets:", offsets
+                plane = planes.next()
+                yield offsetPlane(plane, offsets['x'], offsets['y'], out,
+                                  work)
 
     # create a new image with our generator of numpy planes.
     newImageName = "%s_offsets" % oldImage.getName()
@@ -294,15 +319,15 @@ See http://help.openmicroscopy.org/scripts.html""",
             "Channel_1", grouping="4", default=True,
             description="Choose to include this channel in the output image"),
 
-        scripts.Int(
-            "Channel1_X_shift", grouping="4.1", default=0,
+        scripts.Float(
+            "Channel1_X_shift", grouping="4.1", default=0.0,
             description="Number of pixels to shift this channel in the X "
-            "direction. (negative to shift left)"),
+            "direction. (negative to shift left, fractions are interpolated)"),
 
-        scripts.Int(
-            "Channel1_Y_shift", grouping="4.2", default=0,
+        scripts.Float(
+            "Channel1_Y_shift", grouping="4.2", default=0.0,
             description="Number of pixels to shift this channel in the Y"
-            " direction. (negative to shift up)"),
+            " direction. (negative to shift up, fractions are interpolated)"),
 
         scripts.Int(
             "Channel1_Z_shift", grouping="4.3", default=0,
@@ -312,15 +337,15 @@ See http://help.openmicroscopy.org/scripts.html""",
             "Channel_2", grouping="5", default=True,
             description="Choose to include this channel in the output image"),
 
-        scripts.Int(
-            "Channel2_X_shift", grouping="5.1", default=0,
+        scripts.Float(
+            "Channel2_X_shift", grouping="5.1", default=0.0,
             description="Number of pixels to shift this channel in the X "
-            "direction. (negative to shift left)"),
+            "direction. (negative to shift left, fractions are interpolated)"),
 
-        scripts.Int(
-            "Channel2_Y_shift", grouping="5.2", default=0,
+        scripts.Float(
+            "Channel2_Y_shift", grouping="5.2", default=0.0,
             description="Number of pixels to shift this channel in the Y "
-            "direction. (negative to shift up)"),
+            "direction. (negative to shift up, fractions are interpolated)"),
 
         scripts.Int(
             "Channel2_Z_shift", grouping="5.3", default=0,
@@ -330,15 +355,15 @@ See http://help.openmicroscopy.org/scripts.html""",
             "Channel_3", grouping="6", default=True,
             description="Choose to include this channel in the output image"),
 
-        scripts.Int(
-            "Channel3_X_shift", grouping="6.1", default=0,
+        scripts.Float(
+            "Channel3_X_shift", grouping="6.1", default=0.0,
             description="Number of pixels to shift this channel in the X "
-            "direction. (negative to shift left)"),
+            "direction. (negative to shift left, fractions are interpolated)"),
 
-        scripts.Int(
-            "Channel3_Y_shift", grouping="6.2", default=0,
+        scripts.Float(
+            "Channel3_Y_shift", grouping="6.2", default=0.0,
             description="Number of pixels to shift this channel in the Y "
-            "direction. (negative to shift up)"),
+            "direction. (negative to shift up, fractions are interpolated)"),
 
         scripts.Int(
             "Channel3_Z_shift", grouping="6.3", default=0,
@@ -348,15 +373,15 @@ See http://help.openmicroscopy.org/scripts.html""",
             "Channel_4", grouping="7", default=True,
             description="Choose to include this channel in the output image"),
 
-        scripts.Int(
-            "Channel4_X_shift", grouping="7.1", default=0,
+        scripts.Float(
+            "Channel4_X_shift", grouping="7.1", default=0.0,
             description="Number of pixels to shift this channel in the X "
-            "direction. (negative to shift left)"),
+            "direction. (negative to shift left, fractions are interpolated)"),
 
-        scripts.Int(
-            "Channel4_Y_shift", grouping="7.2", default=0,
+        scripts.Float(
+            "Channel4_Y_shift", grouping="7.2", default=0.0,
             description="Number of pixels to shift this channel in the Y "
-            "direction. (negative to shift up)"),
+            "direction. (negative to shift up, fractions are interpolated)"),
 
         scripts.Int(
             "Channel4_Z_shift", grouping="7.3", default=0,
@@ -36,7 +36,10 @@ additional C, T, Z dimensions.
 """
 
 import re
-from numpy import zeros
+import threading
+import Queue
+from numpy import zeros, ascontiguousarray, dtype, bincount, nonzero, \
+    frombuffer
 
 import omero
 import omero.scripts as scripts
@@ -44,6 +47,7 @@ from omero.gateway import BlitzGateway
 import omero.constants
 from omero.rtypes import rstring, rlong, robject
 import omero.util.script_utils as scriptUtil
+import omero.util.pixelstypetopython as pixelstypetopython
 import time
 
 COLOURS = scriptUtil.COLOURS
@@ -72,6 +76,21 @@ timeRegexes = {
     "None (single time point)": False}
 
 
+# default number of threads downloading source planes
+DOWNLOAD_WORKERS = 2
+# max number of planes uploaded at the same time, by all the datasets
+MAX_CONCURRENT_UPLOADS = 2
+# Ice default for Ice.MessageSizeMax, in KB
+DEFAULT_MESSAGE_SIZE_MAX = 1024
+# fraction of the max message size used for the pixels of one upload,
+# leaving room for the rest of the message
+MESSAGE_PIXELS_FRACTION = 0.9
+# max number of IDs passed to one query
+QUERY_BATCH_SIZE = 1000
+# bytes of a plane scanned at a time for its min and max, small enough to
+# stay in the CPU cache between the two
+MIN_MAX_BLOCK_SIZE = 256 * 1024
+
 startTime = 0
 
 
@@ -83,25 +102,219 @@ def printDuration(output=True):
         print "Script timer = %s secs" % (time.time() - startTime)
 
 
-def getPlane(rawPixelStore, pixels, theZ, theC, theT):
+def getPlaneDtype(pixels):
+    """
+    Returns the numpy dtype of the raw planes of pixels, which are always
+    big-endian.
+    """
+    return dtype('>' + pixelstypetopython.toPython(
+        pixels.getPixelsType().getValue().getValue()))
+
+
+def downloadPlane(rawPixelStore, pixels, theZ, theC, theT):
+    """
+    Retrieves the selected plane as a (sizeY, sizeX) array, read straight
+    from the raw bytes. The array is a read-only view of them.
+
+    @param rawPixelStore:   Raw pixels store, set to the pixels
+    @param pixels:          The omero.model.Pixels object
+    """
+    rawPlane = rawPixelStore.getPlane(theZ, theC, theT)
+    plane2D = frombuffer(rawPlane, dtype=getPlaneDtype(pixels))
+    return plane2D.reshape(pixels.getSizeY().getValue(),
+                           pixels.getSizeX().getValue())
+
+
+def getMaxMessageBytes(client):
+    """
+    Returns the max number of pixel bytes to send in one call, from the
+    Ice.MessageSizeMax of the client.
+    """
+    sizeMax = DEFAULT_MESSAGE_SIZE_MAX
+    try:
+        sizeMax = int(client.getProperty("Ice.MessageSizeMax"))
+    except ValueError:
+        # not set
+        pass
+    return int(sizeMax * 1024 * MESSAGE_PIXELS_FRACTION)
+
+
+def uploadPlane(rawPixelStore, plane2D, theZ, theC, theT, planeDtype,
+                maxBytes=None):
+    """
+    Uploads the plane in one call or, if it is bigger than maxBytes, in
+    blocks of as many rows as fit in maxBytes. The plane is only copied if
+    it is not already a contiguous array of planeDtype.
+    """
+    plane2D = ascontiguousarray(plane2D, dtype=planeDtype)
+    if maxBytes is None or plane2D.nbytes <= maxBytes:
+        rawPixelStore.setPlane(plane2D.data, theZ, theC, theT)
+        return
+    sizeY, sizeX = plane2D.shape
+    rows = max(1, maxBytes / (sizeX * planeDtype.itemsize))
+    for y in range(0, sizeY, rows):
+        block = plane2D[y:y + rows]
+        rawPixelStore.setTile(block.data, theZ, theC, theT, 0, y, sizeX,
+                              block.shape[0])
+
+
+def getMinMax(plane2D):
+    """
+    Returns the (min, max) of the plane, computed a block of rows at a time
+    so the data is only read from memory once.
+    """
+    rows = max(1, MIN_MAX_BLOCK_SIZE / max(1, plane2D[0].nbytes))
+    minValue = None
+    maxValue = None
+    for y in range(0, plane2D.shape[0], rows):
+        block = plane2D[y:y + rows]
+        blockMin = block.min()
+        blockMax = block.max()
+        if minValue is None or blockMin < minValue:
+            minValue = blockMin
+        if maxValue is None or blockMax > maxValue:
+            maxValue = blockMax
+    return minValue, maxValue
+
+
+def getStatsMinMax(pixels):
+    """
+    Returns the (min, max) stored for the first channel of the pixels, or
+    None if they have not been calculated (or the channels not loaded).
+    """
+    if not pixels.isLoaded() or pixels.sizeOfChannels() < 1:
+        return None
+    stats = pixels.getChannel(0).getStatsInfo()
+    if stats is None or not stats.isLoaded():
+        return None
+    return stats.getGlobalMin().getValue(), stats.getGlobalMax().getValue()
+
+
+def downloadSource(rawPixelStore, pixels, planes, maxBytes=None):
     """
-    This method downloads the specified plane of the OMERO image and returns
-    it as a numpy array.
-
-    @param session      The OMERO session
-    @param imageId      The ID of the image to download
-    @param pixels       The pixels object, with pixelsType
-    @param imageName    The name of the image to write. If no path, saved in
-                        the current directory.
+    Downloads the planes of one source image. If they are the whole
+    Z-stack, and it fits in maxBytes, the stack is read in one call.
+
+    @param planes:      List of (planeZ, (z, c, t)), the Z of the source
+                        plane and the position of the plane in the new image
+    @return:            List of ((z, c, t), plane2D, minMax), where minMax is
+                        the (min, max) of the plane, from the stats of the
+                        source image if it has them
     """
+    rawPixelStore.setPixelsId(pixels.getId().getValue(), True)
+    sizeX = pixels.getSizeX().getValue()
+    sizeY = pixels.getSizeY().getValue()
+    sizeZ = pixels.getSizeZ().getValue()
+    planeDtype = getPlaneDtype(pixels)
+    stack = None
+    stackBytes = sizeX * sizeY * sizeZ * planeDtype.itemsize
+    if sizeZ > 1 and len(set([z for z, zct in planes])) == sizeZ and \
+            (maxBytes is None or stackBytes <= maxBytes):
+        stack = frombuffer(rawPixelStore.getStack(0, 0), dtype=planeDtype)
+        stack = stack.reshape(sizeZ, sizeY, sizeX)
+    statsMinMax = getStatsMinMax(pixels)
+    downloaded = []
+    for planeZ, zct in planes:
+        if stack is not None:
+            plane2D = stack[planeZ]
+        else:
+            plane2D = downloadPlane(rawPixelStore, pixels, planeZ, 0, 0)
+        minMax = statsMinMax
+        if minMax is None:
+            minMax = getMinMax(plane2D)
+        downloaded.append((zct, plane2D, minMax))
+    return downloaded
+
+
+def downloadPlanes(rawPixelStores, pixelsMap, sources, maxAhead,
+                   maxBytes=None):
+    """
+    Generator of (theZ, theC, theT, plane2D, minMax) for the planes of each
+    (imageId, planes) of sources, in order. See downloadSource(). An
+    imageId of None is for missing planes (plane2D and minMax are then
+    None).
+    Each of the rawPixelStores is used by its own download thread, so that
+    up to maxAhead sources are downloaded while the planes of the previous
+    sources are being uploaded.
+    """
+    jobs = Queue.Queue()
+    for i, source in enumerate(sources):
+        jobs.put((i, source))
+    slots = threading.Semaphore(maxAhead)
+    stopped = threading.Event()
+    ready = threading.Condition()
+    done = {}
+
+    def download(rawPixelStore):
+        while True:
+            slots.acquire()
+            if stopped.isSet():
+                return
+            try:
+                i, (imageId, planes) = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if imageId is None:
+                    downloaded = [(zct, None, None) for z, zct in planes]
+                else:
+                    downloaded = downloadSource(
+                        rawPixelStore, pixelsMap[imageId], planes, maxBytes)
+            except Exception, e:
+                downloaded = e
+            ready.acquire()
+            try:
+                done[i] = downloaded
+                ready.notify()
+            finally:
+                ready.release()
+
+    threads = [threading.Thread(target=download, args=(store,))
+               for store in rawPixelStores]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for i in range(len(sources)):
+            ready.acquire()
+            try:
+                while i not in done:
+                    ready.wait()
+                downloaded = done.pop(i)
+            finally:
+                ready.release()
+            slots.release()
+            if isinstance(downloaded, Exception):
+                raise downloaded
+            for (theZ, theC, theT), plane2D, minMax in downloaded:
+                yield theZ, theC, theT, plane2D, minMax
+    finally:
+        # stop the download threads, E.g. if an upload failed, and wait
+        # for them so the stores are free for the next image
+        stopped.set()
+        for thread in threads:
+            slots.release()
+        for thread in threads:
+            thread.join()
+
+
+def getPixels(queryService, imageIds):
+    """
+    Loads the pixels, with pixelsType and channel stats, of all the images
+    in one query per QUERY_BATCH_SIZE images.
 
-    # get the plane
-    pixelsId = pixels.getId().getValue()
-    bypassOriginalFile = True
-    rawPixelStore.setPixelsId(pixelsId, bypassOriginalFile)
-    plane2D = scriptUtil.downloadPlane(
-        rawPixelStore, pixels, theZ, theC, theT)
-    return plane2D
+    @return:        Map of imageId: pixels
+    """
+    query_string = "select distinct p from Pixels p join fetch p.image i "\
+        "join fetch p.pixelsType pt left outer join fetch p.channels ch "\
+        "left outer join fetch ch.statsInfo where i.id in (:ids)"
+    pixelsMap = {}
+    for i in range(0, len(imageIds), QUERY_BATCH_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(imageIds[i:i + QUERY_BATCH_SIZE])
+        for pixels in queryService.findAllByQuery(query_string, params):
+            pixelsMap[pixels.getImage().getId().getValue()] = pixels
+    return pixelsMap
 
 
 def manuallyAssignImages(parameterMap, imageIds, sourceZ):
@@ -193,121 +406,112 @@ def assignImagesByRegex(parameterMap, imageIds, queryService, sourceZ,
     if regex_z:
         z = re.compile(regex_z)
 
-    # other parameters we need to determine
-    sizeZ = sourceZ
-    sizeT = 1
-    zStart = None      # could be 0 or 1 ?
-    tStart = None
-
-    imageMap = {}  # map of (z,c,t) : imageId
-    channels = []
-
     if idNameMap is None:
         idNameMap = getImageNames(queryService, imageIds)
 
-    # assign each (imageId,zPlane) to combined image (z,c,t) by name.
-    for iId in imageIds:
+    # parse the Z, C, T of every image from its name in one pass
+    count = len(imageIds)
+    theZs = zeros(count, dtype=int)
+    theCs = zeros(count, dtype=int)
+    theTs = zeros(count, dtype=int)
+    channels = {}   # map of channel name: index
+    for i, iId in enumerate(imageIds):
         name = idNameMap[iId]
         if t:
             tSearch = t.search(name)
+            if tSearch is not None:
+                theTs[i] = int(tSearch.group('T'))
+        cName = "0"
         if c:
             cSearch = c.search(name)
-
-        if t is None or tSearch is None:
-            theT = 0
-        else:
-            theT = int(tSearch.group('T'))
-
-        if c is None or cSearch is None:
-            cName = "0"
-        else:
-            cName = cSearch.group('C')
-        if cName in channels:
-            theC = channels.index(cName)
-        else:
-            theC = len(channels)
-            channels.append(cName)
-
-        sizeT = max(sizeT, theT+1)
-        if tStart is None:
-            tStart = theT
-        else:
-            tStart = min(tStart, theT)
-
-        # we have T and C now. Need to check if source images are Z stacks
+            if cSearch is not None:
+                cName = cSearch.group('C')
+        theCs[i] = channels.setdefault(cName, len(channels))
+        # Z-stacks are not combined in Z
+        if z and sourceZ == 1:
+            zSearch = z.search(name)
+            if zSearch is not None:
+                theZs[i] = int(zSearch.group('Z'))
+
+    # if indexes were 1-based (or higher), shift them to start at 0
+    print "assignImagesByRegex tStart:", theTs.min(), "zStart:", \
+        theZs.min(), "maxT+1:", theTs.max()+1, "maxZ+1:", theZs.max()+1
+    theTs -= theTs.min()
+    theZs -= theZs.min()
+    sizeT = int(theTs.max()) + 1
+    sizeZ = max(sourceZ, int(theZs.max()) + 1)
+    sizeC = len(channels)
+    print "   sizeT:", sizeT, "sizeZ:", sizeZ, "sizeC:", sizeC
+
+    # check every (z, c, t) is from one image, before any pixels are copied
+    keySizeZ = sizeZ
+    if sourceZ > 1:
+        # each image fills all the Z of its C and T
+        keySizeZ = 1
+    keys = (theZs * sizeC + theCs) * sizeT + theTs
+    counts = bincount(keys, minlength=keySizeZ * sizeC * sizeT)
+    duplicates = nonzero(counts[keys] > 1)[0]
+    if len(duplicates):
+        names = [idNameMap[imageIds[i]] for i in duplicates[:10]]
+        raise ValueError("%s images have the same Z, C and T as another"
+                         " image, E.g. %s" % (len(duplicates),
+                                              ", ".join(names)))
+    missing = (counts == 0).sum()
+    if missing:
+        print "%s planes (or Z-stacks) have no image and will be blank" \
+            % missing
+
+    # map of (z,c,t) : (imageId, z)
+    imageMap = {}
+    for iId, theZ, theC, theT in zip(imageIds, theZs.tolist(),
+                                     theCs.tolist(), theTs.tolist()):
         if sourceZ > 1:
-            zStart = 0
-            print "Image STACK ID: %s Name: %s is C: %s T: %s"\
-                "channelName: %s" % (iId, name, theC, theT, cName)
             for srcZ in range(sourceZ):
                 imageMap[(srcZ, theC, theT)] = (iId, srcZ)
         else:
-            if z:
-                zSearch = z.search(name)
-
-            if z is None or zSearch is None:
-                theZ = 0
-            else:
-                theZ = int(zSearch.group('Z'))
-
-            sizeZ = max(sizeZ, theZ+1)
-            if zStart is None:
-                zStart = theZ
-            else:
-                zStart = min(zStart, theZ)
-
-            print "Image ID: %s Name: %s is Z: %s C: %s T: %s "\
-                "channelName: %s" % (iId, name, theZ, theC, theT, cName)
             # every plane comes from z=0
             imageMap[(theZ, theC, theT)] = (iId, 0)
 
-    print "assignImagesByRegex tStart:", tStart, "zStart:", zStart,\
-        "maxT+1:", sizeT, "maxZ+1:", sizeZ
-
-    # if indexes were 1-based (or higher), need to shift indexes accordingly.
-    if tStart > 0 or zStart > 0:
-        sizeT = sizeT-tStart
-        sizeZ = sizeZ-zStart
-        print "   sizeT:", sizeT, "sizeZ:", sizeZ
-        iMap = {}
-        for key, value in imageMap.items():
-            z, c, t = key
-            iMap[(z-zStart, c, t-tStart)] = value
-    else:
-        iMap = imageMap
-
     cNames = {}
-    for c, name in enumerate(channels):
-        cNames[c] = name
-    return (sizeZ, cNames, sizeT, iMap)
+    for name, theC in channels.items():
+        cNames[theC] = name
+    return (sizeZ, cNames, sizeT, imageMap)
 
 
 def getImageNames(queryService, imageIds):
-    idString = ",".join([str(i) for i in imageIds])
-    query_string = "select i from Image i where i.id in (%s)" % idString
-    images = queryService.findAllByQuery(query_string, None)
+    """
+    Loads only the names of the images, in batches of QUERY_BATCH_SIZE IDs
+    passed as query parameters.
+
+    @return:        Map of imageId: name
+    """
     idMap = {}
-    for i in images:
-        iId = i.id.val
-        name = i.name.val
-        idMap[iId] = name
+    query_string = "select i.id, i.name from Image i where i.id in (:ids)"
+    for i in range(0, len(imageIds), QUERY_BATCH_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(imageIds[i:i + QUERY_BATCH_SIZE])
+        for iId, name in queryService.projection(query_string, params):
+            idMap[iId.val] = name.val
     return idMap
 
 
-def makeSingleImage(services, parameterMap, imageIds, dataset, colourMap):
+def makeSingleImage(services, parameterMap, imageIds, dataset, colourMap,
+                    maxBytes=None):
     """
     This takes the images specified by imageIds, sorts them in to Z,C,T
     dimensions according to parameters in the parameterMap, assembles them
     into a new Image, which is saved in dataset.
+
+    @param maxBytes:    Max number of bytes to upload in one call
     """
 
     if len(imageIds) == 0:
-        return
+        return None, None
 
     renderingEngine = services["renderingEngine"]
     queryService = services["queryService"]
     pixelsService = services["pixelsService"]
-    rawPixelStore = services["rawPixelStore"]
+    rawPixelStores = services["rawPixelStores"]
     rawPixelStoreUpload = services["rawPixelStoreUpload"]
     updateService = services["updateService"]
     containerService = services["containerService"]
@@ -324,12 +528,9 @@ def makeSingleImage(services, parameterMap, imageIds, dataset, colourMap):
             imageIds = [i for i in imageIds
                         if idNameMap[i].find(filterString) > -1]
 
-    imageId = imageIds[0]
-
-    # get pixels, with pixelsType, from the first image
-    query_string = "select p from Pixels p join fetch p.image i join "\
-        "fetch p.pixelsType pt where i.id='%d'" % imageId
-    pixels = queryService.findByQuery(query_string, None)
+    # get pixels, with pixelsType, of all the images
+    pixelsMap = getPixels(queryService, imageIds)
+    pixels = pixelsMap[imageIds[0]]
     # use the pixels type object we got from the first image.
     pixelsType = pixels.getPixelsType()
 
@@ -369,29 +570,54 @@ def makeSingleImage(services, parameterMap, imageIds, dataset, colourMap):
     pixelsId = image.getPrimaryPixels().getId().getValue()
     rawPixelStoreUpload.setPixelsId(pixelsId, True)
 
-    for theC in range(sizeC):
-        minValue = 0
-        maxValue = 0
-        for theZ in range(sizeZ):
+    # copy the planes of each source image together, so that each source
+    # is opened once (and Z-stacks read in one call), then fill the gaps.
+    # Sources are downloaded ahead by the download threads and their planes
+    # uploaded here, in this order.
+    sourcePlanes = {}
+    for zct, (imageId, planeZ) in imageMap.items():
+        if zct[0] < sizeZ and zct[1] < sizeC and zct[2] < sizeT:
+            sourcePlanes.setdefault(imageId, []).append((planeZ, zct))
+    sources = [(imageId, sorted(sourcePlanes[imageId]))
+               for imageId in sorted(sourcePlanes)]
+    for theZ in range(sizeZ):
+        for theC in range(sizeC):
             for theT in range(sizeT):
-                if (theZ, theC, theT) in imageMap:
-                    imageId, planeZ = imageMap[(theZ, theC, theT)]
-                    print "Getting plane from Image ID:", imageId
-                    query_string = "select p from Pixels p join fetch "\
-                        "p.image i join fetch p.pixelsType pt where "\
-                        "i.id='%d'" % imageId
-                    pixels = queryService.findByQuery(query_string, None)
-                    plane2D = getPlane(rawPixelStore, pixels, planeZ, 0, 0)
-                else:
-                    print "Creating blank plane for theZ, theC, theT",\
-                        theZ, theC, theT
-                    plane2D = zeros((sizeY, sizeX))
-                print "Uploading plane: theZ: %s, theC: %s, theT: %s"\
-                    % (theZ, theC, theT)
-                scriptUtil.uploadPlaneByRow(
-                    rawPixelStoreUpload, plane2D, theZ, theC, theT)
-                minValue = min(minValue, plane2D.min())
-                maxValue = max(maxValue, plane2D.max())
+                if (theZ, theC, theT) not in imageMap:
+                    sources.append((None, [(0, (theZ, theC, theT))]))
+    minValues = {}
+    maxValues = {}
+    planeDtype = getPlaneDtype(pixels)
+    blankPlane = None
+    maxAhead = 2 * len(rawPixelStores)
+    if sourceZ > 1:
+        # whole stacks are buffered, so keep fewer ahead
+        maxAhead = len(rawPixelStores) + 1
+    for theZ, theC, theT, plane2D, minMax in downloadPlanes(
+            rawPixelStores, pixelsMap, sources, maxAhead, maxBytes):
+        if plane2D is None:
+            print "Creating blank plane for theZ, theC, theT",\
+                theZ, theC, theT
+            # the same blank plane is uploaded for every gap
+            if blankPlane is None:
+                blankPlane = zeros((sizeY, sizeX), dtype=planeDtype)
+            plane2D = blankPlane
+            minMax = (0, 0)
+        print "Uploading plane: theZ: %s, theC: %s, theT: %s"\
+            % (theZ, theC, theT)
+        with services["uploadSlots"]:
+            uploadPlane(rawPixelStoreUpload, plane2D, theZ, theC, theT,
+                        planeDtype, maxBytes)
+        minValue, maxValue = minMax
+        if theC in minValues:
+            minValue = min(minValues[theC], minValue)
+            maxValue = max(maxValues[theC], maxValue)
+        minValues[theC] = minValue
+        maxValues[theC] = maxValue
+
+    for theC in range(sizeC):
+        minValue = minValues.get(theC, 0)
+        maxValue = maxValues.get(theC, 0)
         print "Setting the min, max ", minValue, maxValue
         pixelsService.setChannelGlobalMinMax(pixelsId, theC, float(minValue),
                                              float(maxValue))
@@ -427,20 +653,104 @@ def makeSingleImage(services, parameterMap, imageIds, dataset, colourMap):
     return image, link
 
 
-def combineImages(conn, parameterMap):
+def createServices(conn, parameterMap, uploadSlots):
+    """
+    Returns the services needed by makeSingleImage(). The stateful services
+    (rendering engine and raw pixels stores) are new, so each thread making
+    images needs its own.
 
-    # get the services we need
+    @param uploadSlots:     Semaphore shared by all the threads, limiting
+                            the number of planes uploaded at the same time
+    """
     services = {}
     services["containerService"] = conn.getContainerService()
     services["renderingEngine"] = conn.createRenderingEngine()
     services["queryService"] = conn.getQueryService()
     services["pixelsService"] = conn.getPixelsService()
-    services["rawPixelStore"] = conn.c.sf.createRawPixelsStore()
+    workers = parameterMap.get("Download_Workers", DOWNLOAD_WORKERS)
+    services["rawPixelStores"] = [conn.c.sf.createRawPixelsStore()
+                                  for i in range(max(1, workers))]
     services["rawPixelStoreUpload"] = conn.c.sf.createRawPixelsStore()
     services["updateService"] = conn.getUpdateService()
-    services["rawFileStore"] = conn.createRawFileStore()
+    services["uploadSlots"] = uploadSlots
+    return services
+
+
+def closeServices(services):
+    """ Try and close the stateful services. """
+    for s in [services["renderingEngine"], services["rawPixelStoreUpload"]] \
+            + services["rawPixelStores"]:
+        try:
+            s.close()
+        except:
+            pass
+
+
+def combineDatasets(conn, parameterMap, jobs, colourMap, maxBytes,
+                    services, uploadSlots):
+    """
+    Makes a combined image for each (index, dataset, imageIds) of jobs,
+    combining up to Concurrent_Datasets datasets at the same time. Each
+    thread has its own services, the first using services. A dataset that
+    fails is reported and does not stop the others.
+
+    @return:        Map of index: (image, link, error)
+    """
+    todo = Queue.Queue()
+    for job in jobs:
+        todo.put(job)
+    results = {}
+    progress = threading.Lock()
+
+    def worker(services):
+        while True:
+            try:
+                i, dataset, imageIds = todo.get_nowait()
+            except Queue.Empty:
+                return
+            error = None
+            try:
+                newImg, link = makeSingleImage(services, parameterMap,
+                                               imageIds, dataset, colourMap,
+                                               maxBytes)
+            except Exception, e:
+                newImg, link, error = None, None, e
+            with progress:
+                results[i] = (newImg, link, error)
+                if error is None:
+                    status = "done"
+                else:
+                    status = "FAILED: %s" % error
+                print "Dataset ID: %s (%s of %s datasets finished) %s" \
+                    % (dataset.getId(), len(results), len(jobs), status)
+
+    # the services of the other threads are created here, before the
+    # threads start, as conn.createRenderingEngine() is not thread-safe
+    workers = parameterMap.get("Concurrent_Datasets", 1)
+    workerServices = [createServices(conn, parameterMap, uploadSlots)
+                      for i in range(max(0, min(workers, len(jobs)) - 1))]
+    threads = [threading.Thread(target=worker, args=(s,))
+               for s in workerServices]
+    for thread in threads:
+        thread.start()
+    try:
+        worker(services)
+    finally:
+        for thread in threads:
+            thread.join()
+        for s in workerServices:
+            closeServices(s)
+    return results
+
+
+def combineImages(conn, parameterMap):
+
+    # get the services we need
+    uploadSlots = threading.Semaphore(MAX_CONCURRENT_UPLOADS)
+    services = createServices(conn, parameterMap, uploadSlots)
 
     queryService = services["queryService"]
+    maxBytes = getMaxMessageBytes(conn.c)
 
     colourMap = {}
     if "Channel_Colours" in parameterMap:
@@ -479,13 +789,19 @@ def combineImages(conn, parameterMap):
         else:
             print "No Dataset found for Image ID: %s  Combined Image will "\
                 "not be put into dataset." % imageIds[0]
-        newImg, link = makeSingleImage(services, parameterMap, imageIds,
-                                       dataset, colourMap)
+        try:
+            newImg, link = makeSingleImage(services, parameterMap, imageIds,
+                                           dataset, colourMap, maxBytes)
+        except ValueError, e:
+            print e
+            message += "%s. " % e
+            newImg, link = None, None
         if newImg:
             outputImages.append(newImg)
         if link:
             links.append(link)
     else:
+        jobs = []
         for dataset in objects:
             images = list(dataset.listChildren())
             if not images:
@@ -493,19 +809,19 @@ def combineImages(conn, parameterMap):
                 continue
             images.sort(key=lambda x: (x.getName()))
             imageIds = [i.getId() for i in images]
-            newImg, link = makeSingleImage(services, parameterMap, imageIds,
-                                           dataset, colourMap)
+            jobs.append((len(jobs), dataset, imageIds))
+        results = combineDatasets(conn, parameterMap, jobs, colourMap,
+                                  maxBytes, services, uploadSlots)
+        for i, dataset, imageIds in jobs:
+            newImg, link, error = results[i]
+            if error is not None:
+                message += "Dataset %s: %s. " % (dataset.getName(), error)
             if newImg:
                 outputImages.append(newImg)
             if link:
                 links.append(link)
 
-    # try and close any stateful services
-    for s in services:
-        try:
-            s.close()
-        except:
-            pass
+    closeServices(services)
 
     if outputImages:
         if len(outputImages) > 1:
@@ -619,6 +935,16 @@ See http://help.openmicroscopy.org/scripts.html""",
             "Channel_Names", grouping="8",
             description="List of Names for channels in the new image."),
 
+        scripts.Int(
+            "Download_Workers", grouping="9", default=DOWNLOAD_WORKERS,
+            min=1, description="Number of source planes downloaded at the"
+            " same time, while planes are uploaded to the new image."),
+
+        scripts.Int(
+            "Concurrent_Datasets", grouping="10", default=1, min=1,
+            description="Number of Datasets combined at the same time, if"
+            " Data_Type is 'Dataset'."),
+
         version="4.2.0",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],